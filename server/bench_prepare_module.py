@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+import asyncio
+import os
+import subprocess
+import tempfile
+import time
+
+from package import runner
+from package.build import Build, BuildRow
+from package.worker.worker import Worker, Slot
+
+_GIT_ENV = {
+    "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@localhost",
+    "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@localhost",
+    # Submodules are cloned from local paths.
+    "GIT_CONFIG_COUNT": "1",
+    "GIT_CONFIG_KEY_0": "protocol.file.allow",
+    "GIT_CONFIG_VALUE_0": "always",
+}
+
+
+class BenchWorker(Worker):
+    def __init__(self, root):
+        super().__init__(None, 1)
+        self._root = root
+        self._logger = None
+
+    def waffle_root(self):
+        return self._root
+
+
+def _git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _create_origin(root, num_submodules):
+    origin = root / "origin"
+    _git(root, "init", "-q", "-b", "main", str(origin))
+    (origin / "build.py").write_text("print('build')\n", encoding="utf-8")
+    for i in range(num_submodules):
+        sm = root / f"sm{i}"
+        _git(root, "init", "-q", "-b", "main", str(sm))
+        (sm / "file").write_text(f"{i}\n", encoding="utf-8")
+        _git(sm, "add", ".")
+        _git(sm, "commit", "-qm", "init")
+        _git(origin, "submodule", "add", "-q", str(sm), f"third_party/sm{i}")
+    _git(origin, "add", ".")
+    _git(origin, "commit", "-qm", "init")
+    return origin
+
+
+async def _prepare(worker, slot, origin, jobs):
+    launches = Counter()
+    run = runner.run
+
+    async def counting_run(cmd, *args, **kwargs):
+        git_cmd = cmd[cmd.index("git") + 1:] if "git" in cmd else cmd
+        launches[next(a for a in git_cmd if not a.startswith("-"))] += 1
+        return await run(cmd, *args, **kwargs)
+
+    runner.run = counting_run
+    try:
+        start = time.monotonic()
+        await worker._prepare_module_tree(  # pylint:disable = protected-access
+            slot, asyncio.Semaphore(jobs),
+            [Path("."), Path("."), str(origin), "origin/main"])
+        return launches, time.monotonic() - start
+    finally:
+        runner.run = run
+
+
+async def _main(num_submodules, runs, jobs):
+    os.environ.update(_GIT_ENV)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        origin = _create_origin(root, num_submodules)
+        worker = BenchWorker(root / "waffle")
+        slot = Slot(0, None)
+        slot.build = Build(1, BuildRow(
+            id=1, request=1, project=1, worker_id=1, build_config="bench",
+            remote_url=str(origin), project_name="bench",
+            source_branch="main", build_script="build.py", work_dir="",
+            output_file=None, fetch_depth=None, clone_filter=None,
+            sparse_checkout=None, incremental=False, state="BUILDING",
+            priority=0, requested_at=None, started_at=None, ended_at=None))
+        for i in range(runs):
+            launches, elapsed = await _prepare(worker, slot, origin, jobs)
+            print(f"run {i}: {sum(launches.values())} launches"
+                  f" ({sum(launches.values()) / (num_submodules + 1):.1f}"
+                  f" per module) in {elapsed:.2f}s")
+            for command, count in launches.most_common():
+                print(f"  {command}: {count}")
+
+
+parser = ArgumentParser(
+    description="Counts subprocess launches of a worker preparing a project"
+                " with submodules"
+)
+parser.add_argument("-s", "--submodules", type=int, default=40,
+                    help="number of submodules")
+parser.add_argument("-r", "--runs", type=int, default=2,
+                    help="number of consecutive preparations")
+parser.add_argument("-j", "--jobs", type=int, default=8,
+                    help="number of modules prepared concurrently")
+args = parser.parse_args()
+
+asyncio.run(_main(args.submodules, args.runs, args.jobs))
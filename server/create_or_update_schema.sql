@@ -10,7 +10,11 @@ INSERT IGNORE settings (name, value)
         ("server_timeout", "10"),
         ("log_retention_days", "10"),
         ("waffle_root", "waffle"),
-        ("storage_dir", "storage");
+        ("storage_dir", "storage"),
+        ("affinity_wait", "60"),
+        ("priority_aging", "600"),
+        ("git_jobs", "8"),
+        ("scheduler_address", "127.0.0.1:5002");
 
 CREATE TABLE IF NOT EXISTS log_level (
   severity VARCHAR(5) PRIMARY KEY,
@@ -28,19 +32,53 @@ INSERT IGNORE log_level (severity, rank)
 CREATE TABLE IF NOT EXISTS projects (
   id TINYINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
   name TINYTEXT NOT NULL UNIQUE KEY,
-  remote_url TEXT NOT NULL
+  remote_url TEXT NOT NULL,
+  revision INT UNSIGNED NOT NULL DEFAULT 0
 );
 
+ALTER TABLE projects
+  ADD COLUMN IF NOT EXISTS revision INT UNSIGNED NOT NULL DEFAULT 0;
+
 CREATE TABLE IF NOT EXISTS build_configs (
   project TINYINT UNSIGNED NOT NULL,
   name TINYTEXT NOT NULL,
   build_script TEXT NOT NULL,
   work_dir TEXT NOT NULL,
   output_file TEXT,
+  fetch_depth INT UNSIGNED,
+  clone_filter TINYTEXT,
+  sparse_checkout TEXT,
+  incremental BOOL NOT NULL DEFAULT FALSE,
   UNIQUE KEY (project, name),
   FOREIGN KEY (project) REFERENCES projects(id) ON DELETE CASCADE
 );
 
+-- fetch_depth: shallow fetch with this many commits.
+-- clone_filter: partial clone filter spec, e.g. "blob:none" or "tree:0".
+-- sparse_checkout: whitespace separated sparse-checkout patterns (non-cone)
+--                  for the root module.
+-- incremental: keep build outputs in the work tree instead of cleaning it.
+ALTER TABLE build_configs
+  ADD COLUMN IF NOT EXISTS fetch_depth INT UNSIGNED,
+  ADD COLUMN IF NOT EXISTS clone_filter TINYTEXT,
+  ADD COLUMN IF NOT EXISTS sparse_checkout TEXT,
+  ADD COLUMN IF NOT EXISTS incremental BOOL NOT NULL DEFAULT FALSE;
+
+-- Bump the project revision on build config changes so that cached build
+-- configs get invalidated.
+CREATE TRIGGER IF NOT EXISTS build_configs_insert
+  AFTER INSERT ON build_configs FOR EACH ROW
+  UPDATE projects SET revision = revision + 1 WHERE id = NEW.project;
+
+CREATE TRIGGER IF NOT EXISTS build_configs_update
+  AFTER UPDATE ON build_configs FOR EACH ROW
+  UPDATE projects SET revision = revision + 1
+  WHERE id = OLD.project OR id = NEW.project;
+
+CREATE TRIGGER IF NOT EXISTS build_configs_delete
+  AFTER DELETE ON build_configs FOR EACH ROW
+  UPDATE projects SET revision = revision + 1 WHERE id = OLD.project;
+
 CREATE TABLE IF NOT EXISTS requests (
   id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
   project TINYINT UNSIGNED NOT NULL,
@@ -48,15 +86,56 @@ CREATE TABLE IF NOT EXISTS requests (
   source_branch TEXT NOT NULL,
   target_branch TEXT NOT NULL,
   state ENUM ('REQUESTED', 'BUILDING', 'SUCCEEDED', 'FAILED', 'ABORTED') NOT NULL,
+  priority TINYINT UNSIGNED NOT NULL DEFAULT 0,
   timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   INDEX (target_branch),
   INDEX (state),
   FOREIGN KEY (project) REFERENCES projects(id)
 );
 
+ALTER TABLE requests
+  ADD COLUMN IF NOT EXISTS priority TINYINT UNSIGNED NOT NULL DEFAULT 0
+    AFTER state,
+  ADD INDEX IF NOT EXISTS queue (state, priority, id),
+  ADD INDEX IF NOT EXISTS source_branch (source_branch(255));
+
+-- Number of requests by project and state, kept up to date by triggers so
+-- that counting does not scan the requests table.
+CREATE TABLE IF NOT EXISTS request_counts (
+  project TINYINT UNSIGNED NOT NULL,
+  state ENUM ('REQUESTED', 'BUILDING', 'SUCCEEDED', 'FAILED', 'ABORTED') NOT NULL,
+  count INT UNSIGNED NOT NULL,
+  PRIMARY KEY (project, state)
+);
+
+INSERT IGNORE request_counts (project, state, count)
+  SELECT project, state, COUNT(*) FROM requests GROUP BY project, state;
+
+CREATE TRIGGER IF NOT EXISTS requests_insert
+  AFTER INSERT ON requests FOR EACH ROW
+  INSERT request_counts (project, state, count)
+    VALUE (NEW.project, NEW.state, 1)
+    ON DUPLICATE KEY UPDATE count = count + 1;
+
+CREATE TRIGGER IF NOT EXISTS requests_update
+  AFTER UPDATE ON requests FOR EACH ROW
+  IF NOT (OLD.project <=> NEW.project AND OLD.state <=> NEW.state) THEN
+    UPDATE request_counts SET count = count - 1
+    WHERE project = OLD.project AND state = OLD.state;
+    INSERT request_counts (project, state, count)
+      VALUE (NEW.project, NEW.state, 1)
+      ON DUPLICATE KEY UPDATE count = count + 1;
+  END IF;
+
+CREATE TRIGGER IF NOT EXISTS requests_delete
+  AFTER DELETE ON requests FOR EACH ROW
+  UPDATE request_counts SET count = count - 1
+  WHERE project = OLD.project AND state = OLD.state;
+
 CREATE TABLE IF NOT EXISTS builds (
   id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
   request INT UNSIGNED NOT NULL,
+  project TINYINT UNSIGNED,
   worker_id TINYINT UNSIGNED,
   build_config TINYTEXT NOT NULL,
   remote_url TEXT NOT NULL,
@@ -65,7 +144,13 @@ CREATE TABLE IF NOT EXISTS builds (
   build_script TEXT NOT NULL,
   work_dir TEXT NOT NULL,
   output_file TEXT,
+  fetch_depth INT UNSIGNED,
+  clone_filter TINYTEXT,
+  sparse_checkout TEXT,
+  incremental BOOL NOT NULL DEFAULT FALSE,
   state ENUM ('REQUESTED', 'BUILDING', 'SUCCEEDED', 'FAILED', 'ABORTED') NOT NULL,
+  priority TINYINT UNSIGNED NOT NULL DEFAULT 0,
+  requested_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   started_at TIMESTAMP NOT NULL DEFAULT 0,
   ended_at TIMESTAMP NOT NULL DEFAULT 0,
   duration TEXT AS (TIMESTAMPDIFF(SECOND, started_at, ended_at)),
@@ -74,12 +159,61 @@ CREATE TABLE IF NOT EXISTS builds (
   FOREIGN KEY (request) REFERENCES requests(id)
 );
 
+ALTER TABLE builds
+  ADD COLUMN IF NOT EXISTS project TINYINT UNSIGNED AFTER request,
+  ADD COLUMN IF NOT EXISTS fetch_depth INT UNSIGNED AFTER output_file,
+  ADD COLUMN IF NOT EXISTS clone_filter TINYTEXT AFTER fetch_depth,
+  ADD COLUMN IF NOT EXISTS sparse_checkout TEXT AFTER clone_filter,
+  ADD COLUMN IF NOT EXISTS incremental BOOL NOT NULL DEFAULT FALSE
+    AFTER sparse_checkout,
+  ADD COLUMN IF NOT EXISTS priority TINYINT UNSIGNED NOT NULL DEFAULT 0
+    AFTER state,
+  ADD COLUMN IF NOT EXISTS requested_at TIMESTAMP NOT NULL
+    DEFAULT CURRENT_TIMESTAMP AFTER priority,
+  ADD INDEX IF NOT EXISTS queue (state, priority, id),
+  ADD INDEX IF NOT EXISTS fair_share (state, priority, project, id),
+  ADD INDEX IF NOT EXISTS affinity
+    (state, priority, project, source_branch(255));
+
+UPDATE builds JOIN requests ON requests.id = builds.request
+  SET builds.project = requests.project
+  WHERE builds.project IS NULL;
+
+-- Succeeded builds by a hash of project, build config, build script, work dir,
+-- sparse-checkout patterns and the commits of all modules. Used to skip
+-- building the same sources again. output_file is the output the build stored,
+-- if any.
+CREATE TABLE IF NOT EXISTS build_cache (
+  cache_key CHAR(64) PRIMARY KEY,
+  build INT UNSIGNED NOT NULL,
+  output_file TEXT,
+  FOREIGN KEY (build) REFERENCES builds(id) ON DELETE CASCADE
+);
+
+-- Bumped by the application on every change of requests and builds, the
+-- webapp uses the sum of all rows to validate cached listings. Each
+-- connection bumps the row CONNECTION_ID() MOD 16 so that concurrent writers
+-- do not serialize on a single row.
+CREATE TABLE IF NOT EXISTS queue_revision (
+  id TINYINT UNSIGNED PRIMARY KEY,
+  revision BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
 CREATE TABLE IF NOT EXISTS servers (
   id TINYINT UNSIGNED PRIMARY KEY,
   status ENUM ('IDLE', 'BUSY', 'OFFLINE') NOT NULL,
-  heartbeat TIMESTAMP NOT NULL DEFAULT 0
+  heartbeat TIMESTAMP NOT NULL DEFAULT 0,
+  capacity TINYINT UNSIGNED NOT NULL DEFAULT 1,
+  busy_slots TINYINT UNSIGNED NOT NULL DEFAULT 0
 );
 
+ALTER TABLE servers
+  ADD COLUMN IF NOT EXISTS capacity TINYINT UNSIGNED NOT NULL DEFAULT 1,
+  ADD COLUMN IF NOT EXISTS busy_slots TINYINT UNSIGNED NOT NULL DEFAULT 0;
+
+-- No longer written to, logs are stored in segment files under
+-- storage_dir/logs (see log_store.py). Existing records are deleted in chunks
+-- once past retention, using the timestamp index.
 CREATE TABLE IF NOT EXISTS logs (
   id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
   server_id TINYINT UNSIGNED NOT NULL,
@@ -89,6 +223,9 @@ CREATE TABLE IF NOT EXISTS logs (
   INDEX (server_id)
 );
 
+ALTER TABLE logs
+  ADD INDEX IF NOT EXISTS timestamp (timestamp);
+
 --
 -- Test data
 --
@@ -0,0 +1,85 @@
+import errno
+import hashlib
+import os
+import threading
+import time
+
+# Build outputs are stored once per content under storage_dir/blobs. Build
+# directories hard link to the blobs, so a blob with a single link is not used
+# by any build anymore. Blobs are written to a temporary file next to them
+# first, named with a leading dot.
+
+# Temporary files older than this many seconds were left by a crashed worker.
+TMP_MAX_AGE = 24 * 60 * 60
+
+
+def blobs_dir(storage_dir):
+    return storage_dir / "blobs"
+
+
+def store(storage_dir, src, dst):
+    with open(src, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    blob = blobs_dir(storage_dir) / digest[:2] / digest
+    dst.unlink(missing_ok=True)
+    while True:
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            # Builds of a worker store their outputs in threads.
+            tmp = blob.with_name(
+                f".{digest}.{os.getpid()}.{threading.get_ident()}")
+            try:
+                _copy_file(src, tmp)
+                os.replace(tmp, blob)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+        try:
+            os.link(blob, dst)
+            return digest
+        except FileNotFoundError:
+            # Removed by garbage collection in the meantime.
+            continue
+
+
+def collect_garbage(storage_dir):
+    removed = 0
+    for blob in blobs_dir(storage_dir).glob("*/*"):
+        try:
+            stat = blob.stat()
+            if blob.name.startswith("."):
+                # Still being written, unless it is old.
+                if time.time() - stat.st_mtime > TMP_MAX_AGE:
+                    blob.unlink()
+            elif stat.st_nlink == 1:
+                blob.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _copy_file(src, dst):
+    # Copy in the kernel. copy_file_range can also share extents on file
+    # systems that support it. Fall back to sendfile where it is not supported.
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        use_sendfile = False
+        offset = 0
+        while offset < size:
+            if use_sendfile:
+                n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset,
+                                size - offset)
+            else:
+                try:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                           size - offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS,
+                                       errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    use_sendfile = True
+                    continue
+            if n == 0:
+                break
+            offset += n
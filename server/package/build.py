@@ -1,11 +1,48 @@
-from . import db
+from collections import namedtuple
+from . import db, queue_revision
 from .entity import Entity
 
 
+BuildRow = namedtuple(
+    'BuildRow', ['id', 'request', 'project', 'worker_id', 'build_config',
+                 'remote_url', 'project_name', 'source_branch', 'build_script',
+                 'work_dir', 'output_file', 'fetch_depth', 'clone_filter',
+                 'sparse_checkout', 'incremental', 'state', 'priority',
+                 'requested_at', 'started_at', 'ended_at'])
+
+
+# Fields of jsonified builds and their columns.
+_JSON_COLUMNS = {
+    "id": "id",
+    "request_id": "request",
+    "worker_id": "worker_id",
+    "build_config": "build_config",
+    "remote_url": "remote_url",
+    "source_branch": "source_branch",
+    "build_script": "build_script",
+    "output_file": "output_file",
+    "state": "state",
+    "started_at": "DATE_FORMAT(started_at, '%%Y-%%m-%%d %%H:%%i')",
+    "duration": "duration",
+}
+BUILD_FIELDS = tuple(_JSON_COLUMNS)
+
+# Queued builds of a warm work tree tried per affinity pair, in case other
+# workers are locking the oldest ones.
+AFFINITY_CANDIDATES = 4
+
+
 class Build(Entity):
+    __slots__ = ()
+    _table = 'builds'
+    _Row = BuildRow
+
     def request(self):
         return self._fetch('request')
 
+    def project(self):
+        return self._fetch('project')
+
     def worker_id(self):
         return self._fetch('worker_id')
 
@@ -30,6 +67,22 @@ class Build(Entity):
     def output_file(self):
         return self._fetch('output_file')
 
+    def fetch_depth(self):
+        return self._fetch('fetch_depth')
+
+    def clone_filter(self):
+        return self._fetch('clone_filter')
+
+    def sparse_checkout_patterns(self):
+        patterns = self._fetch('sparse_checkout')
+        return patterns.split() if patterns else []
+
+    def incremental(self):
+        return bool(self._fetch('incremental'))
+
+    def priority(self):
+        return self._fetch('priority')
+
     def is_requested(self):
         return self._fetch('state') == 'REQUESTED'
 
@@ -60,6 +113,8 @@ class Build(Entity):
                            "  THEN 'SUCCEEDED' ELSE state"
                            " END"
                            " WHERE id=%s", (self.id()))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     def set_failed(self):
         with db.cursor() as cursor:
@@ -73,6 +128,8 @@ class Build(Entity):
                            "  THEN 'FAILED' ELSE state"
                            " END"
                            " WHERE id=%s", (self.id()))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     def set_aborted(self):
         with db.cursor() as cursor:
@@ -86,89 +143,195 @@ class Build(Entity):
                            "  THEN 'ABORTED' ELSE state"
                            " END"
                            " WHERE id=%s", (self.id()))
-
-    @staticmethod
-    def _jsonify(row):
-        keys = [
-            "id",
-            "request_id",
-            "worker_id",
-            "build_config",
-            "remote_url",
-            "source_branch",
-            "build_script",
-            "output_file",
-            "state",
-            "started_at",
-            "duration"
-        ]
-        return dict(zip(keys, row))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     # pylint:disable = too-many-arguments
     @staticmethod
-    def create(request, build_config, remote_url, project_name, source_branch,
-               build_script, work_dir, output_file, state='REQUESTED'):
+    def create_many(request, project, remote_url, project_name, source_branch,
+                    build_configs, priority=0, state='REQUESTED'):
+        # Create one build per BuildConfig in a single statement.
+        if not build_configs:
+            return []
+        values = []
+        for config in build_configs:
+            values += [request, project, config.name, remote_url, project_name,
+                       source_branch, config.build_script, config.work_dir,
+                       config.output_file, config.fetch_depth,
+                       config.clone_filter, config.sparse_checkout,
+                       config.incremental, state, priority]
+        placeholders = ", ".join(
+            ["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] *
+            len(build_configs))
         with db.cursor() as cursor:
             cursor.execute("INSERT INTO builds"
-                           " (request, build_config, remote_url, project_name,"
-                           "  source_branch, build_script, work_dir,"
-                           "  output_file, state)"
-                           " VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
-                           " RETURNING id", (request, build_config, remote_url,
-                                             project_name, source_branch,
-                                             build_script, work_dir,
-                                             output_file, state))
-            return Build(*cursor.fetchone())
+                           " (request, project, build_config, remote_url,"
+                           "  project_name, source_branch, build_script,"
+                           "  work_dir, output_file, fetch_depth,"
+                           "  clone_filter, sparse_checkout, incremental,"
+                           "  state, priority)"
+                           f" VALUES {placeholders}"
+                           " RETURNING id", values)
+            builds = [Build(*row) for row in cursor]
+            queue_revision.bump(cursor)
+            return builds
 
     @staticmethod
-    def list(request, jsonify=False):
-        if jsonify:
-            with db.cursor() as cursor:
-                cursor.execute("SELECT id, request, worker_id, build_config,"
-                               "       remote_url, source_branch, build_script,"
-                               "       output_file, state,"
-                               "       DATE_FORMAT(started_at,"
-                               "                   '%%Y-%%m-%%d %%H:%%i'),"
-                               "       duration"
-                               " FROM builds WHERE request=%s"
-                               " ORDER BY id DESC", (request))
-                return [Build._jsonify(row) for row in cursor]
-
+    def list(request):
         with db.cursor() as cursor:
             cursor.execute("SELECT id FROM builds WHERE request=%s"
                            " ORDER BY id DESC", (request))
             return [Build(*row) for row in cursor]
 
     @staticmethod
-    def builds_in_progress():
+    def list_many(request_ids, fields=None):
+        # Returns {request id: [jsonified builds]} with one query, each build
+        # holding only the given fields (all by default) and its id.
+        request_ids = list(request_ids)
+        if fields is None:
+            fields = list(_JSON_COLUMNS)
+        fields = ["id"] + [f for f in fields if f != "id"]
+        if not request_ids:
+            return {}
+        placeholders = ", ".join(["%s"] * len(request_ids))
+        columns = ", ".join(_JSON_COLUMNS[f] for f in fields)
+        builds = {request_id: [] for request_id in request_ids}
         with db.cursor() as cursor:
-            cursor.execute("SELECT id FROM builds WHERE state='BUILDING'")
-            return [Build(*row) for row in cursor]
+            cursor.execute(f"SELECT request, {columns} FROM builds"
+                           f" WHERE request IN ({placeholders})"
+                           " ORDER BY id DESC", request_ids)
+            for row in cursor:
+                builds[row[0]].append(dict(zip(fields, row[1:])))
+        return builds
 
     @staticmethod
-    def pop_next_build_request(worker_id):
+    def progress(request_ids):
+        # Returns {request id: (number of open builds, all builds succeeded)}
+        request_ids = list(request_ids)
+        if not request_ids:
+            return {}
+        placeholders = ", ".join(["%s"] * len(request_ids))
+        with db.cursor() as cursor:
+            cursor.execute("SELECT request,"
+                           "       SUM(state IN ('REQUESTED', 'BUILDING')),"
+                           "       MIN(state='SUCCEEDED')"
+                           " FROM builds"
+                           f" WHERE request IN ({placeholders})"
+                           " GROUP BY request", request_ids)
+            return {row[0]: (int(row[1]), bool(row[2])) for row in cursor}
+
+    @staticmethod
+    def fail_builds_of_offline_workers():
+        # Set every build whose worker is offline or missed its heartbeat as
+        # failed. Returns the ids of the failed builds.
+        with db.cursor() as cursor:
+            cursor.execute("SELECT builds.id FROM builds"
+                           " JOIN servers ON servers.id=builds.worker_id"
+                           " JOIN settings ON settings.name='server_timeout'"
+                           " WHERE builds.state='BUILDING' AND"
+                           "       (servers.status='OFFLINE' OR"
+                           "        servers.heartbeat <"
+                           "        NOW() - INTERVAL settings.value SECOND)"
+                           " FOR UPDATE")
+            build_ids = [row[0] for row in cursor]
+            if build_ids:
+                placeholders = ", ".join(["%s"] * len(build_ids))
+                cursor.execute("UPDATE builds SET"
+                               " state='FAILED', ended_at=NOW()"
+                               f" WHERE id IN ({placeholders})"
+                               " AND state='BUILDING'", build_ids)
+                queue_revision.bump(cursor)
+            return build_ids
+
+    @staticmethod
+    def pop_next_build_request(worker_id, affinity=()):
         # Fetch the next available build request from the queue and mark it as
         # building.
         build = None
         db.commit()  # Start new transaction
         with db.cursor() as cursor:
-            cursor.execute("SELECT id FROM builds"
-                           " WHERE state='REQUESTED'"
-                           " ORDER BY id"
-                           " FOR UPDATE SKIP LOCKED")
-            build_id = cursor.fetchone()
+            build_id = Build._lock_next_build(cursor, affinity)
             if build_id is not None:
-                build = Build(*build_id)
+                build = Build(build_id)
                 cursor.execute("UPDATE builds SET"
                                " state='BUILDING', worker_id=%s,"
                                " started_at=NOW()"
                                " WHERE id=%s", (worker_id, build.id()))
+                queue_revision.bump(cursor)
+                build.load()
         db.commit()  # Release locks
         return build
 
-    def _fetch(self, field):
-        with db.cursor() as cursor:
-            cursor.execute(f"SELECT {field} FROM builds WHERE id=%s",
-                           (self.id()))
+    @staticmethod
+    def _lock_next_build(cursor, affinity):
+        # Priorities are tried from the highest effective priority down. A
+        # priority gains one level for every priority_aging seconds its oldest
+        # build waited, so that lower priorities do not starve. A priority
+        # whose builds are all being locked by other workers is passed over.
+        # Once the oldest build of a priority waited longer than affinity_wait
+        # seconds, affinity no longer applies to it.
+        cursor.execute("SELECT queued.priority,"
+                       "       builds.requested_at < NOW() - INTERVAL"
+                       "        (SELECT value FROM settings"
+                       "         WHERE name='affinity_wait') SECOND"
+                       " FROM (SELECT priority, MIN(id) AS head FROM builds"
+                       "       WHERE state='REQUESTED'"
+                       "       GROUP BY priority) AS queued"
+                       " JOIN builds ON builds.id=queued.head"
+                       " ORDER BY queued.priority +"
+                       "  TIMESTAMPDIFF(SECOND, builds.requested_at, NOW()) /"
+                       "  (SELECT value FROM settings"
+                       "   WHERE name='priority_aging') DESC,"
+                       "  queued.priority DESC")
+        for priority, overdue in cursor.fetchall():
+            build_id = Build._lock_build_of_priority(
+                cursor, priority, () if overdue else affinity)
+            if build_id is not None:
+                return build_id
+        return None
+
+    @staticmethod
+    def _lock_build_of_priority(cursor, priority, affinity):
+        # Builds matching a (project, source_branch) pair in affinity come
+        # first, in that order, so that the worker can reuse a warm work tree.
+        # Then the oldest build of the project with the fewest running builds
+        # (fair share).
+        # Locking reads go by primary key, or by an index matching their
+        # whole condition. Under REPEATABLE READ a locking read keeps every
+        # row it scanned locked until commit, even the ones it rejected.
+        def lock(condition, args=()):
+            cursor.execute("SELECT id FROM builds"
+                           " WHERE state='REQUESTED' AND priority=%s"
+                           f" AND {condition}"
+                           " ORDER BY id LIMIT 1"
+                           " FOR UPDATE SKIP LOCKED", (priority, *args))
             r = cursor.fetchone()
             return r[0] if r is not None else None
+
+        for project, source_branch in affinity:
+            cursor.execute("SELECT id FROM builds"
+                           " WHERE state='REQUESTED' AND priority=%s"
+                           " AND project<=>%s AND source_branch=%s"
+                           " ORDER BY id LIMIT %s",
+                           (priority, project, source_branch,
+                            AFFINITY_CANDIDATES))
+            for candidate in [row[0] for row in cursor]:
+                build_id = lock("id=%s", (candidate,))
+                if build_id is not None:
+                    return build_id
+
+        cursor.execute("SELECT queued.head FROM"
+                       " (SELECT project, MIN(id) AS head FROM builds"
+                       "  WHERE state='REQUESTED' AND priority=%s"
+                       "  GROUP BY project) AS queued"
+                       " LEFT JOIN builds AS running"
+                       "  ON running.state='BUILDING' AND"
+                       "     running.project<=>queued.project"
+                       " GROUP BY queued.project, queued.head"
+                       " ORDER BY COUNT(running.id), queued.head", (priority))
+        for head in [row[0] for row in cursor]:
+            build_id = lock("id=%s", (head,))
+            if build_id is not None:
+                return build_id
+
+        return lock("TRUE")
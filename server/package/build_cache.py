@@ -0,0 +1,27 @@
+from . import db
+
+
+# Results of succeeded builds by cache key, with the output file they stored.
+# A build with an output file can serve requests for the same file or for
+# none, a build without can only serve requests without. Requests for another
+# file (after a build config change) are built again.
+def lookup(cache_key, output_file):
+    with db.cursor() as cursor:
+        cursor.execute("SELECT build FROM build_cache"
+                       " WHERE cache_key=%s AND"
+                       "       (%s IS NULL OR output_file<=>%s)",
+                       (cache_key, output_file, output_file))
+        r = cursor.fetchone()
+        return r[0] if r is not None else None
+
+
+def store(cache_key, build_id, output_file):
+    with db.cursor() as cursor:
+        cursor.execute("INSERT INTO build_cache"
+                       " (cache_key, build, output_file)"
+                       " VALUES (%s, %s, %s)"
+                       " ON DUPLICATE KEY UPDATE"
+                       "  build=IF(%s IS NULL, build, VALUES(build)),"
+                       "  output_file=IFNULL(VALUES(output_file),"
+                       "                     output_file)",
+                       (cache_key, build_id, output_file, output_file))
@@ -1,6 +1,18 @@
+from . import db
+
+
 class Entity:
-    def __init__(self, id_):
+    __slots__ = ('_id', '_row')
+
+    # Subclasses set the table name and a namedtuple describing its columns.
+    # A loaded entity keeps its whole row as a snapshot and getters read from
+    # it until refresh() is called. Unloaded entities query field by field.
+    _table = None
+    _Row = None
+
+    def __init__(self, id_, row=None):
         self._id = id_
+        self._row = row
 
     def __eq__(self, other):
         return isinstance(other, Entity) and self._id == other._id
@@ -14,5 +26,53 @@ class Entity:
     def is_valid(self):
         return self._fetch("id") is not None
 
-    def _fetch(self, _field):
-        pass
+    def is_loaded(self):
+        return self._row is not None
+
+    def load(self):
+        with db.cursor() as cursor:
+            cursor.execute(f"SELECT {self._columns()} FROM {self._table}"
+                           " WHERE id=%s", (self.id()))
+            r = cursor.fetchone()
+            self._row = self._Row(*r) if r is not None else None
+        return self
+
+    def refresh(self):
+        return self.load()
+
+    def unload(self):
+        self._row = None
+        return self
+
+    @classmethod
+    def load_many(cls, ids):
+        ids = list(ids)
+        if not ids:
+            return []
+        placeholders = ", ".join(["%s"] * len(ids))
+        return cls._select(f"id IN ({placeholders})", ids)
+
+    @classmethod
+    def _columns(cls):
+        return ", ".join(cls._Row._fields)
+
+    @classmethod
+    def _from_row(cls, row):
+        row = cls._Row(*row)
+        return cls(row.id, row)
+
+    @classmethod
+    def _select(cls, condition, args=None, order="id"):
+        with db.cursor() as cursor:
+            cursor.execute(f"SELECT {cls._columns()} FROM {cls._table}"
+                           f" WHERE {condition} ORDER BY {order}", args)
+            return [cls._from_row(row) for row in cursor]
+
+    def _fetch(self, field):
+        if self._row is not None:
+            return getattr(self._row, field)
+        with db.cursor() as cursor:
+            cursor.execute(f"SELECT {field} FROM {self._table} WHERE id=%s",
+                           (self.id()))
+            r = cursor.fetchone()
+            return r[0] if r is not None else None
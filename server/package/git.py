@@ -1,8 +1,14 @@
+import os
 import re
 
 from . import runner
 
 
+# Matches a section header in a git config file, e.g. [remote "origin"]
+_SECTION_RE = re.compile(
+    r'\s*\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+
+
 async def rev_list(git_dir, commit, options=None, limit=None, logger=None):
     if options is None:
         options = []
@@ -16,16 +22,23 @@ async def rev_list(git_dir, commit, options=None, limit=None, logger=None):
     return output.splitlines()
 
 
-async def init_or_update(git_dir, name, url, logger=None):
-    if (git_dir / "config").exists():
-        existing_url = None
-        remotes = await list_remotes(git_dir, logger=logger)
-        for existing_remote in remotes:
-            remote_name, remote_url, _ = existing_remote.split()
-            if remote_name == name:
-                existing_url = remote_url
-                break
+async def rev_parse(git_dir, rev, logger=None):
+    output = await runner.run([
+        "git",
+        f"--git-dir={git_dir}",
+        "rev-parse",
+        "--verify",
+        f"{rev}^{{commit}}"], output=runner.PIPE, logger=logger)
+    return output.strip()
 
+
+async def init_or_update(git_dir, name, url, reference=None, logger=None):
+    if reference is not None:
+        await init_reference(reference, logger=logger)
+        add_alternate(git_dir, reference)
+
+    if (git_dir / "config").exists():
+        existing_url = get_remote_url(git_dir, name)
         if existing_url is None:
             await add_remote(git_dir, name, url, logger=logger)
         elif existing_url != url:
@@ -35,6 +48,60 @@ async def init_or_update(git_dir, name, url, logger=None):
         await add_remote(git_dir, name, url, logger=logger)
 
 
+# A reference is a bare repository shared by all workers of a host. Worker
+# repositories borrow its objects via alternates so that objects are downloaded
+# and stored once per host. Workers may use a reference concurrently, so git
+# commands on it are serialized with a lock file.
+def _reference_lock(reference):
+    return ["flock", str(reference / "waffle.lock")]
+
+
+async def init_reference(reference, logger=None):
+    if (reference / "HEAD").exists():
+        return
+    reference.mkdir(parents=True, exist_ok=True)
+    await runner.run(_reference_lock(reference) + [
+        "git",
+        "init",
+        "--bare",
+        "-q",
+        str(reference)], logger=logger)
+    # Worker repositories may need objects that are no longer reachable from
+    # the reference.
+    await runner.run(_reference_lock(reference) + [
+        "git",
+        f"--git-dir={reference}",
+        "config",
+        "gc.pruneExpire",
+        "never"], logger=logger)
+
+
+async def fetch_reference(reference, url, refspec, logger=None):
+    # Every fetch goes to the same ref. A ref per branch or pinned commit
+    # would pile up, and worker fetches advertise all refs of their
+    # alternates. Objects it no longer points to are kept, see gc.pruneExpire.
+    await runner.run(_reference_lock(reference) + [
+        "git",
+        f"--git-dir={reference}",
+        "fetch",
+        "-fn",
+        url,
+        f"+{refspec}:refs/cache/HEAD"], logger=logger)
+
+
+def add_alternate(git_dir, reference):
+    alternates = git_dir / "objects" / "info" / "alternates"
+    objects = str(reference / "objects")
+    try:
+        if objects in alternates.read_text(encoding="utf-8").splitlines():
+            return
+    except FileNotFoundError:
+        pass
+    alternates.parent.mkdir(parents=True, exist_ok=True)
+    with open(alternates, "a", encoding="utf-8") as f:
+        f.write(objects + "\n")
+
+
 async def add_remote(git_dir, remote, url, logger=None):
     await runner.run([
         "git",
@@ -53,19 +120,45 @@ async def set_remote_url(git_dir, remote, url, logger=None):
         remote, url], logger=logger)
 
 
-async def list_remotes(git_dir, logger=None):
-    output = await runner.run([
-        "git",
-        f"--git-dir={git_dir}",
-        "remote",
-        "-v"], output=runner.PIPE, logger=logger)
-    return output.splitlines()
+def get_remote_url(git_dir, remote):
+    # Read from the config file directly instead of running git.
+    section = None
+    for line in _read_config(git_dir):
+        header = _SECTION_RE.match(line)
+        if header:
+            section = (header.group(1).lower(), header.group(2))
+            continue
+        if section == ("remote", remote):
+            key, _, value = line.partition("=")
+            if key.strip().lower() == "url":
+                value = value.strip()
+                if len(value) > 1 and value[0] == value[-1] == '"':
+                    value = re.sub(r'\\(.)', r'\1', value[1:-1])
+                return value
+    return None
+
 
+# pylint:disable = too-many-arguments
+async def fetch(git_dir, remote, refspec, recurse_submodules="no",
+                reference=None, url=None, depth=None, filter_spec=None,
+                logger=None):
+    # With a reference, objects are fetched into it first from url. The fetch
+    # into git_dir then finds them via alternates and only updates refs.
+    if reference is not None:
+        await fetch_reference(reference, url, refspec, logger=logger)
 
-async def fetch(git_dir, remote, refspec, recurse_submodules="no", logger=None):
     options = []
     if recurse_submodules is not None:
         options.append(f"--recurse-submodules={recurse_submodules}")
+    if depth is not None:
+        options.append(f"--depth={depth}")
+    elif (git_dir / "shallow").exists():
+        options.append("--unshallow")
+    if filter_spec is not None:
+        # Missing objects are fetched on demand from a promisor remote.
+        await set_config(git_dir, f"remote.{remote}.promisor", "true",
+                         logger=logger)
+        options.append(f"--filter={filter_spec}")
     cmd = [
         "git",
         f"--git-dir={git_dir}",
@@ -75,6 +168,36 @@ async def fetch(git_dir, remote, refspec, recurse_submodules="no", logger=None):
     await runner.run(cmd + options + [remote, refspec], logger=logger)
 
 
+async def set_config(git_dir, name, value, logger=None):
+    await runner.run([
+        "git",
+        f"--git-dir={git_dir}",
+        "config",
+        name,
+        value], logger=logger)
+
+
+async def set_sparse_checkout(git_dir, work_tree, patterns, logger=None):
+    # Patterns are in gitignore format (non-cone mode) and limit what the next
+    # checkout writes to the work tree. No patterns disables sparse checkout.
+    if patterns:
+        await runner.run([
+            "git",
+            f"--git-dir={git_dir}",
+            f"--work-tree={work_tree}",
+            "sparse-checkout",
+            "set",
+            "--no-cone"] + patterns, logger=logger)
+    elif (git_dir / "info" / "sparse-checkout").exists():
+        await runner.run([
+            "git",
+            f"--git-dir={git_dir}",
+            f"--work-tree={work_tree}",
+            "sparse-checkout",
+            "disable"], logger=logger)
+        (git_dir / "info" / "sparse-checkout").unlink(missing_ok=True)
+
+
 async def init(git_dir, logger=None):
     await runner.run([
         "git",
@@ -112,7 +235,7 @@ async def last_commit_timestamp(git_dir, logger=None):
 
 
 async def init_submodules(git_dir, work_tree, logger=None):
-    await unregister_submodules(git_dir, logger=logger)
+    unregister_submodules(git_dir)
 
     output = await runner.run([
         "git",
@@ -133,21 +256,29 @@ async def init_submodules(git_dir, work_tree, logger=None):
     return submodules
 
 
-async def unregister_submodules(git_dir, logger=None):
-    output = await runner.run([
-        "git",
-        f"--git-dir={git_dir}",
-        "config",
-        "list",
-        "--name-only"], output=runner.PIPE, logger=logger)
-    for line in output.splitlines():
-        if line.startswith("submodule."):
-            await runner.run([
-                "git",
-                f"--git-dir={git_dir}",
-                "config",
-                "unset",
-                line], logger=logger)
+def unregister_submodules(git_dir):
+    # Drop all submodule sections with a single rewrite of the config file
+    # instead of running git for each key.
+    lines = _read_config(git_dir)
+    kept = []
+    is_submodule = False
+    for line in lines:
+        header = _SECTION_RE.match(line)
+        if header:
+            is_submodule = header.group(1).lower() == "submodule"
+        if not is_submodule:
+            kept.append(line)
+    if len(kept) == len(lines):
+        return
+    tmp = git_dir / "config.waffle"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(kept)
+    os.replace(tmp, git_dir / "config")
+
+
+def _read_config(git_dir):
+    with open(git_dir / "config", encoding="utf-8") as f:
+        return f.readlines()
 
 
 async def submodule_status(git_dir, work_tree, logger=None):
@@ -0,0 +1,136 @@
+import gzip
+import json
+import zlib
+from datetime import datetime
+
+# Log records of a server are appended to gzip compressed segment files in a
+# directory of its own. A segment is named after the id and the time of its
+# first record, so the directory listing is the index used to seek to an id or
+# a time. Only the newest segment is written to, older ones are deleted
+# whole once past retention.
+
+# A new segment is started once the current one is this large (compressed) or
+# this old (seconds).
+SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_AGE = 60 * 60
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _segment_name(first_id, first_time):
+    return f"{first_id:012d}-{int(first_time.timestamp())}.log.gz"
+
+
+def segments(directory):
+    # Returns [(first id, first time, path)] ordered by id.
+    result = []
+    try:
+        paths = list(directory.glob("*.log.gz"))
+    except OSError:
+        return result
+    for path in paths:
+        try:
+            first_id, first_time = path.name.removesuffix(".log.gz").split("-")
+            result.append((int(first_id),
+                           datetime.fromtimestamp(int(first_time)), path))
+        except ValueError:
+            continue
+    result.sort()
+    return result
+
+
+def _read_segment(path):
+    # Yields the records of a segment. The newest segment may end with a
+    # partially written block, or have been cut short by a crash, reading
+    # stops there.
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    return
+                yield json.loads(line)
+    except (FileNotFoundError, EOFError, zlib.error, gzip.BadGzipFile,
+            ValueError):
+        return
+
+
+class LogStore:
+    def __init__(self, directory):
+        self._directory = directory
+        self._file = None
+        self._path = None
+        self._started_at = None
+        self._next_id = None
+
+    def append(self, records):
+        # records: [(datetime, severity, message)]
+        if self._file is None or self._should_rotate():
+            self._start_segment(records[0][0])
+        lines = []
+        for timestamp, severity, message in records:
+            lines.append(json.dumps([self._next_id,
+                                     timestamp.strftime(TIMESTAMP_FORMAT),
+                                     severity, message]) + "\n")
+            self._next_id += 1
+        self._file.write("".join(lines).encode("utf-8"))
+        # Readers see everything written up to a sync flush.
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _should_rotate(self):
+        return (self._path.stat().st_size >= SEGMENT_SIZE or
+                (datetime.now() - self._started_at).total_seconds() >=
+                SEGMENT_AGE)
+
+    def _start_segment(self, first_time):
+        if self._next_id is None:
+            # Continue after the last record written by a previous process.
+            # Its segment may be incomplete, it is never appended to.
+            self._directory.mkdir(parents=True, exist_ok=True)
+            self._next_id = 1
+            existing = segments(self._directory)
+            if existing:
+                self._next_id = existing[-1][0]
+                for record in _read_segment(existing[-1][2]):
+                    self._next_id = record[0] + 1
+        self.close()
+        self._path = self._directory / _segment_name(self._next_id,
+                                                     first_time)
+        self._started_at = datetime.now()
+        # Only exists if a previous process wrote nothing readable to it.
+        self._file = gzip.open(self._path, "wb")
+
+
+def read(directory, severities=None, since_id=0, start=None, end=None):
+    # Yields [id, timestamp, severity, message] of the records after since_id
+    # logged in [start, end), reading only the segments that can hold them.
+    all_segments = segments(directory)
+    first = 0
+    for i, (first_id, first_time, _) in enumerate(all_segments):
+        if first_id <= since_id + 1 or (start is not None and
+                                        first_time <= start):
+            first = i
+    start = start.strftime(TIMESTAMP_FORMAT) if start is not None else None
+    end = end.strftime(TIMESTAMP_FORMAT) if end is not None else None
+    for _, _, path in all_segments[first:]:
+        for record in _read_segment(path):
+            if record[0] <= since_id:
+                continue
+            if start is not None and record[1] < start:
+                continue
+            if end is not None and record[1] >= end:
+                return
+            if severities is None or record[2] in severities:
+                yield record
+
+
+def expired_segments(directory, before):
+    # Segments whose records were all logged before the given time. The
+    # newest segment is never expired, it may still be written to.
+    all_segments = segments(directory)
+    return [path for (_, _, path), (_, next_time, _)
+            in zip(all_segments, all_segments[1:]) if next_time <= before]
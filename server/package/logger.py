@@ -1,105 +1,208 @@
+import asyncio
+import itertools
+import time
+from collections import deque
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
 
 from pymysql.err import OperationalError, InterfaceError
-from . import db
+from . import db, settings, log_store
+
+# The log level is read from the settings at most every LEVEL_TTL seconds.
+LEVEL_TTL = 10
+# Queued records are written to the log store FLUSH_INTERVAL seconds after the
+# first one was queued, or as soon as FLUSH_ROWS are queued.
+FLUSH_INTERVAL = 1
+FLUSH_ROWS = 500
+MAX_QUEUED = 10000
+# Logger.clear deletes at most this many segments per call.
+CLEAR_CHUNK_SIZE = 10
+# Logger.clear_table deletes at most this many records per statement.
+CLEAR_TABLE_CHUNK_SIZE = 1000
+
+# Most severe first.
+SEVERITIES = ('FATAL', 'ERROR', 'WARN', 'INFO', 'DEBUG', 'TRACE')
 
 
 class Logger:
+    _levels = {}
+    _levels_expire_at = 0
+
     def __init__(self, server_id):
         self._server_id = server_id
+        self._queue = deque()
+        self._dropped = 0
+        self._full = asyncio.Event()
+        self._flusher = None
+        self._store = None
+
+    @staticmethod
+    def log_dir(server_id=None):
+        logs_dir = (Path.home() / settings.waffle_root() /
+                    settings.storage_dir() / "logs")
+        return logs_dir if server_id is None else logs_dir / str(server_id)
+
+    @staticmethod
+    def retention_cutoff():
+        # Records logged before this time are past retention.
+        return datetime.now() - timedelta(days=settings.log_retention_days())
 
     @staticmethod
-    def clear():
+    def clear(before, max_segments=CLEAR_CHUNK_SIZE):
+        # Deletes at most max_segments segments of records logged before the
+        # given time, the oldest first. Returns the number of deleted
+        # segments.
+        removed = 0
+        try:
+            for server_dir in sorted(Logger.log_dir().glob("*")):
+                for path in log_store.expired_segments(server_dir, before):
+                    if removed >= max_segments:
+                        return removed
+                    path.unlink(missing_ok=True)
+                    removed += 1
+        except (OperationalError, InterfaceError):
+            # Can happen when task gets canceled due to disconnection
+            pass
+        except OSError as e:
+            print(f"Cannot clear log: {e}")
+        return removed
+
+    @staticmethod
+    def clear_table(max_rows=CLEAR_TABLE_CHUNK_SIZE):
+        # Deletes at most max_rows expired records of the logs table, which
+        # is no longer written to, the oldest first. Returns the number of
+        # deleted records. Small chunks keep the transaction and its locks
+        # short.
         try:
             with db.cursor() as cursor:
                 cursor.execute("DELETE FROM logs WHERE timestamp <"
                                " (SELECT DATE_SUB(NOW(), INTERVAL value DAY)"
                                "  FROM settings"
-                               "  WHERE name='log_retention_days')")
+                               "  WHERE name='log_retention_days')"
+                               " ORDER BY timestamp LIMIT %s", (max_rows))
+                return cursor.rowcount
         except (OperationalError, InterfaceError):
             # Can happen when task gets canceled due to disconnection
-            return
+            return 0
 
     @staticmethod
-    def list(server_id, max_severity='TRACE'):
-        with db.cursor() as cursor:
-            cursor.execute("SELECT timestamp, severity, message"
-                           " FROM logs WHERE severity<="
-                           " (SELECT rank FROM log_level"
-                           "  WHERE severity=%s and server_id=%s)"
-                           " ORDER BY id",
-                           (max_severity, server_id))
-            return "\n".join(
-                [str(row[0]) + " " + str(row[1]) + "\t" + str(row[2])
-                 for row in cursor])
+    def list(server_id, max_severity='TRACE', since_id=0, start=None,
+             end=None, limit=None):
+        # Yields [id, timestamp, severity, message] of the records after
+        # since_id, logged in [start, end).
+        if max_severity not in SEVERITIES:
+            raise ValueError(f"Unknown severity: {max_severity}")
+        severities = None
+        if max_severity != SEVERITIES[-1]:
+            severities = SEVERITIES[:SEVERITIES.index(max_severity) + 1]
+        return itertools.islice(
+            log_store.read(Logger.log_dir(server_id), severities, since_id,
+                           start, end), limit)
 
     @staticmethod
     def is_log_on(severity):
-        with db.cursor() as cursor:
-            cursor.execute(
-                "SELECT asked_level.rank <= required_level.rank"
-                " FROM log_level AS asked_level, log_level AS required_level"
-                " WHERE asked_level.severity=%s AND required_level.severity="
-                "  (SELECT value FROM settings WHERE name='log_level')",
-                (severity))
-            r = cursor.fetchone()
-            return bool(r[0]) if r is not None else False
+        now = time.monotonic()
+        if Logger._levels_expire_at <= now:
+            with db.cursor() as cursor:
+                cursor.execute(
+                    "SELECT asked_level.severity,"
+                    "       asked_level.rank <= required_level.rank"
+                    " FROM log_level AS asked_level,"
+                    "      log_level AS required_level"
+                    " WHERE required_level.severity="
+                    "  (SELECT value FROM settings WHERE name='log_level')")
+                Logger._levels = {row[0]: bool(row[1]) for row in cursor}
+            Logger._levels_expire_at = now + LEVEL_TTL
+        return Logger._levels.get(severity, False)
 
     @contextmanager
     def bulk_logger(self, severity):
-        def log(message):
-            if message:
-                self._log(severity, message)
-
-        def noop(_message):
-            pass
-
         if not Logger.is_log_on(severity):
-            yield noop
-            return
-        try:
-            yield log
-        except (OperationalError, InterfaceError):
-            # Can happen when task gets canceled due to disconnection
+            yield lambda _message: None
             return
-        # pylint:disable = bare-except
-        try:
-            db.commit()
-        except:
-            pass
+        yield lambda message: self._enqueue(severity, message)
 
-    def log(self, severity, message, commit=True):
+    def log(self, severity, message):
         try:
-            if not message or not Logger.is_log_on(severity):
-                return
-            self._log(severity, message)
-            if commit:
-                db.commit()
+            if message and Logger.is_log_on(severity):
+                self._enqueue(severity, message)
         except (OperationalError, InterfaceError):
             # Can happen when task gets canceled due to disconnection
             pass
 
-    def fatal(self, message, commit=True):
-        self.log('FATAL', message, commit)
+    def fatal(self, message):
+        self.log('FATAL', message)
 
-    def error(self, message, commit=True):
-        self.log('ERROR', message, commit)
+    def error(self, message):
+        self.log('ERROR', message)
 
-    def warn(self, message, commit=True):
-        self.log('WARN', message, commit)
+    def warn(self, message):
+        self.log('WARN', message)
 
-    def info(self, message, commit=True):
-        self.log('INFO', message, commit)
+    def info(self, message):
+        self.log('INFO', message)
 
-    def debug(self, message, commit=True):
-        self.log('DEBUG', message, commit)
+    def debug(self, message):
+        self.log('DEBUG', message)
 
-    def trace(self, message, commit=True):
-        self.log('TRACE', message, commit)
+    def trace(self, message):
+        self.log('TRACE', message)
 
-    def _log(self, severity, message):
-        with db.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO logs (server_id, severity, message)"
-                " VALUES (%s, %s, %s)",
-                (self._server_id, severity, message))
+    def flush(self):
+        # Write all queued records. Records stay queued if they cannot be
+        # written.
+        self._full.clear()
+        try:
+            if self._store is None:
+                self._store = log_store.LogStore(
+                    Logger.log_dir(self._server_id))
+            if self._dropped:
+                self._queue.append((datetime.now(), 'WARN',
+                                    f"Dropped {self._dropped} log records"))
+                self._dropped = 0
+            if self._queue:
+                self._store.append(list(self._queue))
+                self._queue.clear()
+        except (OperationalError, InterfaceError):
+            # Can happen when task gets canceled due to disconnection
+            pass
+        except OSError as e:
+            print(f"Cannot write log: {e}")
+
+    def close(self):
+        self.flush()
+        if self._store is not None:
+            self._store.close()
+
+    def _enqueue(self, severity, message):
+        # Records are queued and written in batches by a background task.
+        # Logging never waits for the log store: when the queue is full new
+        # records are dropped and counted.
+        if not message:
+            return
+        if len(self._queue) >= MAX_QUEUED:
+            self._dropped += 1
+            return
+        self._queue.append((datetime.now(), severity, message))
+        if len(self._queue) >= FLUSH_ROWS:
+            self._full.set()
+        if self._flusher is None or self._flusher.done():
+            try:
+                self._flusher = asyncio.get_running_loop().create_task(
+                    self._flush_later())
+            except RuntimeError:
+                # No event loop to flush later.
+                self.flush()
+
+    async def _flush_later(self):
+        while self._queue or self._dropped:
+            try:
+                await asyncio.wait_for(self._full.wait(), FLUSH_INTERVAL)
+            except TimeoutError:
+                pass
+            queued = len(self._queue)
+            self.flush()
+            if len(self._queue) == queued:
+                # Cannot write, try again later.
+                await asyncio.sleep(FLUSH_INTERVAL)
@@ -0,0 +1,51 @@
+import asyncio
+import socket
+
+import lazy_object_proxy
+from . import settings
+
+# The scheduler listens on the scheduler_address setting for change
+# notifications from the webapp and workers, which may run on other hosts.
+# Notifications are best effort, the scheduler still polls periodically in
+# case one gets lost.
+
+
+def _create_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    return sock
+
+
+_sock = lazy_object_proxy.Proxy(_create_socket)
+_address = None
+
+
+def _scheduler_address():
+    # Read once per process, a changed address takes effect on restart.
+    global _address  # pylint:disable = global-statement
+    if _address is None:
+        _address = settings.scheduler_address()
+    return _address
+
+
+class _Listener(asyncio.DatagramProtocol):
+    def __init__(self, callback):
+        self._callback = callback
+
+    def datagram_received(self, data, addr):
+        self._callback(data.decode("utf-8", errors="replace"))
+
+
+def notify(message):
+    try:
+        _sock.sendto(message.encode("utf-8"), _scheduler_address())
+    except OSError:
+        # Nobody is listening or the buffer is full. The poll will catch up.
+        pass
+
+
+async def listen(callback):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _Listener(callback), local_addr=_scheduler_address())
+    return transport
@@ -4,22 +4,47 @@ from .entity import Entity
 
 
 BuildConfig = namedtuple(
-    'BuildConfig', ['name', 'build_script', 'work_dir', 'output_file'])
+    'BuildConfig', ['name', 'build_script', 'work_dir', 'output_file',
+                    'fetch_depth', 'clone_filter', 'sparse_checkout',
+                    'incremental'])
+ProjectRow = namedtuple(
+    'ProjectRow', ['id', 'name', 'remote_url', 'revision'])
+
+# project id: (revision, [BuildConfig]). Triggers bump the project revision
+# whenever its build configs change, which invalidates the cached entry.
+_build_configs_cache = {}
 
 
 class Project(Entity):
+    __slots__ = ()
+    _table = 'projects'
+    _Row = ProjectRow
+
     def name(self):
         return self._fetch('name')
 
     def remote_url(self):
         return self._fetch('remote_url')
 
+    def revision(self):
+        return self._fetch('revision')
+
     def build_configs(self):
+        revision = self.revision()
+        cached = _build_configs_cache.get(self.id())
+        if cached is not None and cached[0] == revision:
+            return list(cached[1])
+
         with db.cursor() as cursor:
-            cursor.execute("SELECT name, build_script, work_dir, output_file"
+            cursor.execute("SELECT name, build_script, work_dir, output_file,"
+                           "       fetch_depth, clone_filter, sparse_checkout,"
+                           "       incremental"
                            " FROM build_configs WHERE project=%s",
                            (self.id()))
-            return [BuildConfig(*row) for row in cursor]
+            configs = [BuildConfig(*row) for row in cursor]
+        if revision is not None:
+            _build_configs_cache[self.id()] = (revision, configs)
+        return list(configs)
 
     @staticmethod
     def _jsonify(row):
@@ -50,10 +75,3 @@ class Project(Entity):
         with db.cursor() as cursor:
             cursor.execute("SELECT id FROM projects ORDER BY id")
             return [Project(*row) for row in cursor]
-
-    def _fetch(self, field):
-        with db.cursor() as cursor:
-            cursor.execute(f"SELECT {field} FROM projects WHERE id=%s",
-                           (self.id()))
-            r = cursor.fetchone()
-            return r[0] if r is not None else None
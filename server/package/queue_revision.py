@@ -0,0 +1,21 @@
+from . import db
+
+# The queue revision changes with every change of requests and builds, the
+# webapp uses it to validate cached listings. It is the sum of a few counter
+# rows. Writers bump the row of their connection once per state change, so
+# that concurrent transactions rarely wait on the same row lock.
+SHARDS = 16
+
+
+def bump(cursor):
+    cursor.execute("INSERT queue_revision (id, revision)"
+                   " VALUE (CONNECTION_ID() MOD %s, 1)"
+                   " ON DUPLICATE KEY UPDATE revision = revision + 1",
+                   (SHARDS))
+
+
+def current():
+    with db.cursor() as cursor:
+        cursor.execute("SELECT SUM(revision) FROM queue_revision")
+        r = cursor.fetchone()
+        return int(r[0]) if r is not None and r[0] is not None else 0
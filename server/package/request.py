@@ -1,8 +1,24 @@
-from . import db
+from collections import namedtuple
+from . import db, queue_revision
 from .entity import Entity
 
 
+RequestRow = namedtuple(
+    'RequestRow', ['id', 'project', 'integration', 'source_branch',
+                   'target_branch', 'state', 'priority', 'timestamp'])
+
+# Priority classes. Builds of requests with a higher priority are dispatched
+# first.
+PRIORITY_INTEGRATION = 0
+PRIORITY_BUILD = 1
+PRIORITY_MAX = 255
+
+
 class Request(Entity):
+    __slots__ = ()
+    _table = 'requests'
+    _Row = RequestRow
+
     def project(self):
         return self._fetch('project')
 
@@ -15,6 +31,9 @@ class Request(Entity):
     def target_branch(self):
         return self._fetch('target_branch')
 
+    def priority(self):
+        return self._fetch('priority')
+
     def is_requested(self):
         return self._fetch('state') == 'REQUESTED'
 
@@ -36,6 +55,8 @@ class Request(Entity):
                            "WHEN (state='REQUESTED') "
                            "THEN 'BUILDING' ELSE state "
                            "END WHERE id=%s", (self.id()))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     def set_succeeded(self):
         with db.cursor() as cursor:
@@ -43,6 +64,8 @@ class Request(Entity):
                            "WHEN (state='REQUESTED' OR state='BUILDING') "
                            "THEN 'SUCCEEDED' ELSE state "
                            "END WHERE id=%s", (self.id()))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     def set_failed(self):
         with db.cursor() as cursor:
@@ -50,6 +73,8 @@ class Request(Entity):
                            "WHEN (state='REQUESTED' OR state='BUILDING') "
                            "THEN 'FAILED' ELSE state "
                            "END WHERE id=%s", (self.id()))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     def set_aborted(self):
         with db.cursor() as cursor:
@@ -57,6 +82,8 @@ class Request(Entity):
                            "WHEN (state='REQUESTED' OR state='BUILDING') "
                            "THEN 'ABORTED' ELSE state "
                            "END WHERE id=%s", (self.id()))
+            if cursor.rowcount:
+                queue_revision.bump(cursor)
 
     @staticmethod
     def _jsonify(row):
@@ -66,60 +93,95 @@ class Request(Entity):
             "integration",
             "source_branch",
             "target_branch",
-            "state"
+            "state",
+            "priority"
         ]
         return dict(zip(keys, row))
 
     @staticmethod
     def create(project, integration, source_branch, target_branch,
-               state='REQUESTED'):
+               priority=None, state='REQUESTED'):
+        if priority is None:
+            priority = PRIORITY_INTEGRATION if integration else PRIORITY_BUILD
         with db.cursor() as cursor:
             cursor.execute("INSERT INTO requests"
                            " (project, integration, source_branch,"
-                           "  target_branch, state)"
+                           "  target_branch, state, priority)"
                            " VALUES ((SELECT id FROM projects WHERE name=%s),"
-                           "         %s, %s, %s, %s) RETURNING id",
+                           "         %s, %s, %s, %s, %s) RETURNING id",
                            (project, integration, source_branch, target_branch,
-                            state))
-            return Request(*cursor.fetchone())
+                            state, priority))
+            request = Request(*cursor.fetchone())
+            queue_revision.bump(cursor)
+            return request
+
+    @staticmethod
+    def _filter(project=None, state=None, branch=None):
+        # Returns the WHERE conditions and their arguments. Each filter is
+        # backed by an index that also orders by id.
+        conditions = []
+        args = []
+        if project is not None:
+            conditions.append("project=(SELECT id FROM projects"
+                              " WHERE name=%s)")
+            args.append(project)
+        if state is not None:
+            conditions.append("state=%s")
+            args.append(state)
+        if branch is not None:
+            conditions.append("(source_branch=%s OR target_branch=%s)")
+            args += [branch, branch]
+        return conditions, args
 
     @staticmethod
-    def count():
+    def count(project=None, state=None, branch=None):
+        if branch is not None:
+            conditions, args = Request._filter(project, state, branch)
+            with db.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM requests"
+                               f" WHERE {' AND '.join(conditions)}", args)
+                return cursor.fetchone()[0]
+
+        # Counts by project and state are maintained by triggers.
+        conditions, args = Request._filter(project, state)
         with db.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) FROM requests")
-            return cursor.fetchone()[0]
+            cursor.execute("SELECT COALESCE(SUM(count), 0) FROM request_counts"
+                           f" WHERE {' AND '.join(conditions or ['TRUE'])}",
+                           args)
+            return int(cursor.fetchone()[0])
 
+    # pylint:disable = too-many-arguments
     @staticmethod
-    def list(offset, limit, jsonify=False):
+    def list(offset, limit, jsonify=False, before=None, project=None,
+             state=None, branch=None):
+        # Newest first. Pages after the first one are read without scanning
+        # the skipped rows when the caller passes the last id it got as
+        # before, instead of an offset.
+        conditions, args = Request._filter(project, state, branch)
+        if before is not None:
+            conditions.append("id < %s")
+            args.append(before)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
         if jsonify:
             with db.cursor() as cursor:
                 cursor.execute("SELECT id, project, integration, source_branch,"
-                               "       target_branch, state"
-                               " FROM requests ORDER BY id DESC"
-                               " LIMIT %s OFFSET %s", (limit, offset))
+                               "       target_branch, state, priority"
+                               f" FROM requests{where} ORDER BY id DESC"
+                               " LIMIT %s OFFSET %s", (*args, limit, offset))
                 return [Request._jsonify(row) for row in cursor]
 
         with db.cursor() as cursor:
-            cursor.execute("SELECT id FROM requests ORDER BY id DESC"
-                           " LIMIT %s OFFSET %s", (limit, offset))
+            cursor.execute(f"SELECT id FROM requests{where} ORDER BY id DESC"
+                           " LIMIT %s OFFSET %s", (*args, limit, offset))
             return [Request(*row) for row in cursor]
 
     @staticmethod
     def get_new_requests():
-        with db.cursor() as cursor:
-            cursor.execute("SELECT id FROM requests WHERE state='REQUESTED'"
-                           " ORDER BY id")
-            return [Request(*row) for row in cursor]
+        return Request._select("state='REQUESTED'",
+                               order="priority DESC, id")
 
     @staticmethod
     def get_building_requests():
         with db.cursor() as cursor:
             cursor.execute("SELECT id FROM requests WHERE state='BUILDING'")
             return [Request(*row) for row in cursor]
-
-    def _fetch(self, field):
-        with db.cursor() as cursor:
-            cursor.execute(f"SELECT {field} FROM requests WHERE id=%s",
-                           (self.id()))
-            r = cursor.fetchone()
-            return r[0] if r is not None else None
@@ -1,8 +1,14 @@
 import asyncio
+from contextlib import nullcontext
 
 
 PIPE = asyncio.subprocess.PIPE
 
+# Output is read in chunks of this size. Lines longer than MAX_LINE are split
+# so that memory stays bounded whatever the command prints.
+CHUNK_SIZE = 64 * 1024
+MAX_LINE = 64 * 1024
+
 
 class RunProcessError(Exception):
     def __init__(self, returncode, output):
@@ -10,62 +16,121 @@ class RunProcessError(Exception):
         self.output = output
 
 
-# pylint:disable = too-many-branches
+async def _read_lines(reader):
+    pending = b""
+    while True:
+        chunk = await reader.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        *complete, pending = pending.split(b"\n")
+        for line in complete:
+            yield line + b"\n"
+        while len(pending) >= MAX_LINE:
+            yield pending[:MAX_LINE]
+            pending = pending[MAX_LINE:]
+    if pending:
+        yield pending
+
+
+async def _terminate(proc, cmd, logger):
+    if logger is not None:
+        logger.debug(f"Terminating {cmd[0]}")
+    try:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=10)
+        except TimeoutError:
+            proc.kill()
+            if logger is not None:
+                logger.warn(f"Killed {cmd[0]}")
+    except ProcessLookupError:
+        pass
+
+
+# pylint:disable = too-many-arguments
+async def lines(cmd, cwd=None, env=None, logger=None, encoding="utf-8",
+                keepends=False):
+    # Yields the output of cmd (stdout and stderr) line by line while it runs.
+    # Raises RunProcessError once the output ends if cmd failed.
+    if logger is not None:
+        logger.debug(f"Run: '{' '.join(cmd)}'")
+
+    proc = await asyncio.create_subprocess_exec(
+        cmd[0], *cmd[1:],
+        cwd=cwd, env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        process_group=0)
+
+    try:
+        async for line in _read_lines(proc.stdout):
+            if not keepends:
+                line = line.removesuffix(b"\n")
+            if encoding is not None:
+                line = line.decode(encoding, errors="replace")
+            yield line
+        await proc.wait()
+    except BaseException:
+        # Canceled, or the caller stopped iterating.
+        await _terminate(proc, cmd, logger)
+        raise
+    finally:
+        await proc.wait()
+
+    if logger is not None:
+        logger.debug(f"Exit code: {proc.returncode}")
+    if proc.returncode:
+        raise RunProcessError(proc.returncode, None)
+
+
 # pylint:disable = too-many-arguments
 async def run(cmd, cwd=None, env=None, output=None, logger=None,
               encoding="utf-8"):
+    if output == PIPE or (output is None and logger is not None):
+        # Lines are logged as they come in. They are only kept in memory when
+        # the caller asked for the output.
+        captured = [] if output == PIPE else None
+        with (logger.bulk_logger('TRACE') if logger is not None else
+              nullcontext(lambda _line: None)) as log:
+            try:
+                async for line in lines(cmd, cwd=cwd, env=env, logger=logger,
+                                        encoding=encoding, keepends=True):
+                    log(line.rstrip("\n" if encoding is not None else b"\n"))
+                    if captured is not None:
+                        captured.append(line)
+            except RunProcessError as e:
+                e.output = _join(captured, encoding)
+                raise
+        return _join(captured, encoding)
+
     if logger is not None:
         logger.debug(f"Run: '{' '.join(cmd)}'")
 
-    if output is None:
-        if logger is None:
-            stdout = asyncio.subprocess.DEVNULL
-            stderr = asyncio.subprocess.DEVNULL
-        else:
-            stdout = asyncio.subprocess.PIPE
-            stderr = asyncio.subprocess.STDOUT
-    else:
-        stdout = output
-        stderr = asyncio.subprocess.STDOUT
-
     proc = await asyncio.create_subprocess_exec(
         cmd[0], *cmd[1:],
         cwd=cwd, env=env,
-        stdout=stdout,
-        stderr=stderr,
+        stdout=output if output is not None else asyncio.subprocess.DEVNULL,
+        stderr=(asyncio.subprocess.STDOUT if output is not None else
+                asyncio.subprocess.DEVNULL),
         process_group=0)
 
     try:
-        if stdout == asyncio.subprocess.PIPE:
-            stdout, _ = await proc.communicate()
-            if encoding is not None:
-                stdout = stdout.decode(encoding)
-            if logger is not None:
-                with logger.bulk_logger('TRACE') as log:
-                    for line in stdout.splitlines():
-                        log(line)
-        else:
-            await proc.wait()
-            stdout = None
-
-        if logger is not None:
-            logger.debug(f"Exit code: {proc.returncode}")
-        if proc.returncode:
-            raise RunProcessError(proc.returncode, stdout)
-        return stdout
+        await proc.wait()
     except asyncio.CancelledError:
-        if logger is not None:
-            logger.debug(f"Terminating {cmd[0]}")
-        try:
-            proc.terminate()
-            try:
-                await asyncio.wait_for(proc.wait(), timeout=10)
-            except TimeoutError:
-                proc.kill()
-                if logger is not None:
-                    logger.warn(f"Killed {cmd[0]}")
-        except ProcessLookupError:
-            pass
+        await _terminate(proc, cmd, logger)
         raise
     finally:
-        await proc.communicate()
+        await proc.wait()
+
+    if logger is not None:
+        logger.debug(f"Exit code: {proc.returncode}")
+    if proc.returncode:
+        raise RunProcessError(proc.returncode, None)
+    return None
+
+
+def _join(captured, encoding):
+    if captured is None:
+        return None
+    return ("" if encoding is not None else b"").join(captured)
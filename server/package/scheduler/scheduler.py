@@ -1,8 +1,10 @@
 import asyncio
-from dataclasses import dataclass
+from pathlib import Path
+from dataclasses import dataclass, field
 from datetime import timedelta
 from pymysql.err import OperationalError, InterfaceError
 from . import db
+from .. import notifier, artifacts, settings
 from ..shutdown_handler import ShutdownHandler
 from ..task import Task
 from ..project import Project
@@ -17,11 +19,21 @@ class RequestTraits:
     request: Request
     task: Task
     builds: list[Build]
+    # Set by Scheduler.update once all builds are closed.
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+    succeeded: bool = False
 
 
 # (project_id, target_branch | request_id): RequestTraits
 type ScheduledRequests = dict[(int, str | int), RequestTraits]
 
+# Changes are pushed by the webapp and workers via the notifier. Polling is
+# only a safety net and must stay below server_timeout to keep the heartbeat.
+POLL_INTERVAL = 5
+
+# Pause between two chunks of expired log segments or records.
+CLEAR_LOG_PAUSE = 0.1
+
 
 class Scheduler:
     def __init__(self, task_group):
@@ -30,17 +42,21 @@ class Scheduler:
         self._server: Server = None
         self._logger = Logger(0)
         self._clear_log_task = Task(task_group, self._clear_log)
+        self._collect_artifacts_task = Task(
+            task_group, self._collect_artifacts)
+        self._changed = asyncio.Event()
 
     def connected(self):
         # Server id 0 is the scheduler
         self._server = Server.create(0)
 
         self._clear_log_task.start()
+        self._collect_artifacts_task.start()
 
         # Abort orphaned requests.
         for request in Request.get_building_requests():
             self._logger.info("Aborting orphaned requests! id: "
-                              f"{request.id()}", commit=False)
+                              f"{request.id()}")
             for build in Build.list(request.id()):
                 build.set_aborted()
             request.set_aborted()
@@ -48,35 +64,59 @@ class Scheduler:
 
     async def disconnected(self):
         await self._clear_log_task.cancel()
+        await self._collect_artifacts_task.cancel()
 
         for request_traits in self._scheduled_requests.copy().values():
             await request_traits.task.cancel()
 
     async def shutdown(self):
         await self._clear_log_task.cancel()
+        await self._collect_artifacts_task.cancel()
 
         for request_traits in self._scheduled_requests.copy().values():
             await request_traits.task.cancel()
         if self._server is not None:
             self._server.set_offline()
+        self._logger.close()
         db.commit()
 
+    def notify(self, _message):
+        self._changed.set()
+
+    async def wait_for_changes(self, timeout):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except TimeoutError:
+            pass
+        self._changed.clear()
+
     async def update(self):
         self._server.update_heartbeat()
         db.commit()
 
         # Set builds with offline workers as failed
-        for build in Build.builds_in_progress():
-            if Server(build.worker_id()).is_offline():
-                self._logger.info("Set build failed (offline worker)! id: "
-                                  f"{build.id()}", commit=False)
-                build.set_failed()
+        for build_id in Build.fail_builds_of_offline_workers():
+            self._logger.info("Set build failed (offline worker)! id: "
+                              f"{build_id}")
         db.commit()
 
         # Cancel tasks for aborted requests.
-        for request_traits in self._scheduled_requests.copy().values():
-            if request_traits.request.is_aborted():
-                await request_traits.task.cancel()
+        scheduled = {request_traits.request.id(): request_traits
+                     for request_traits in self._scheduled_requests.values()}
+        for request in Request.load_many(scheduled):
+            if request.is_aborted():
+                await scheduled[request.id()].task.cancel()
+
+        # Check progress of all requests in process with a single query.
+        in_process = {request_id: request_traits
+                      for request_id, request_traits in scheduled.items()
+                      if request_traits.builds and
+                      request_traits.task.running()}
+        progress = Build.progress(in_process)
+        for request_id, (num_open, all_succeeded) in progress.items():
+            if num_open == 0:
+                in_process[request_id].succeeded = all_succeeded
+                in_process[request_id].done.set()
 
         # Check for new requests.
         for request in Request.get_new_requests():
@@ -100,31 +140,31 @@ class Scheduler:
         print("Processing request: " f"{request_traits.request.id()}")
         self._logger.info("Processing request! id: "
                           f"{request_traits.request.id()}, "
-                          f"branch: {request_traits.request.source_branch()}",
-                          commit=False)
+                          f"branch: {request_traits.request.source_branch()}")
 
         try:
             self._server.set_busy()
 
             # Create a build job for each build configuration in the project.
             # Jobs will be picked up by workers.
-            project = Project(request_traits.request.project())
-            for config in project.build_configs():
-                build = Build.create(request_traits.request.id(), config.name,
-                                     project.remote_url(), project.name(),
-                                     request_traits.request.source_branch(),
-                                     config.build_script, config.work_dir,
-                                     config.output_file
-                                     if not request_traits.request.integration()
-                                     and config.output_file else None)
-                request_traits.builds.append(build)
+            project = Project(request_traits.request.project()).load()
+            configs = [config._replace(
+                output_file=config.output_file
+                if not request_traits.request.integration()
+                and config.output_file else None)
+                for config in project.build_configs()]
+            request_traits.builds.extend(Build.create_many(
+                request_traits.request.id(), project.id(),
+                project.remote_url(), project.name(),
+                request_traits.request.source_branch(), configs,
+                request_traits.request.priority()))
             db.commit()
 
             # Wait for workers to build all configurations.
-            while any(build.is_open() for build in request_traits.builds):
-                await asyncio.sleep(2)
-
-            return all(build.is_succeeded() for build in request_traits.builds)
+            if not request_traits.builds:
+                return True
+            await request_traits.done.wait()
+            return request_traits.succeeded
         except (OperationalError, InterfaceError):
             # Can happen when task gets canceled due to disconnection
             pass
@@ -134,7 +174,7 @@ class Scheduler:
         print(f"Request complete: {request_traits.request.id()}"
               f" result: {str(result)}")
         self._logger.info(f"Request complete: {request_traits.request.id()}"
-                          f" result: {str(result)}", commit=False)
+                          f" result: {str(result)}")
         try:
             # Abort builds if request was canceled
             if result == 'CANCELED':
@@ -153,10 +193,48 @@ class Scheduler:
         finally:
             del self._scheduled_requests[request_key]
 
+    async def _collect_artifacts(self):
+        while True:
+            storage_dir = (Path.home() / settings.waffle_root() /
+                           settings.storage_dir())
+            db.commit()
+            try:
+                removed = await asyncio.to_thread(
+                    artifacts.collect_garbage, storage_dir)
+                self._logger.info(f"Removed {removed} unused artifacts")
+            except OSError as e:
+                self._logger.error(f"Cannot collect artifacts: {e}")
+            await asyncio.sleep(timedelta(days=1).total_seconds())
+
     async def _clear_log(self):
         while True:
-            Logger.clear()
+            # Expired log segments are deleted a few at a time, pausing in
+            # between so that requests keep getting scheduled. If interrupted,
+            # the next run continues where this one stopped.
+            before = Logger.retention_cutoff()
             db.commit()
+            removed = 0
+            while True:
+                count = Logger.clear(before)
+                if not count:
+                    break
+                removed += count
+                self._logger.debug(f"Removed {removed} log segments so far")
+                await asyncio.sleep(CLEAR_LOG_PAUSE)
+            if removed:
+                self._logger.info(f"Removed {removed} log segments")
+
+            # Records left in the logs table from before the log store.
+            removed = 0
+            while True:
+                count = Logger.clear_table()
+                db.commit()
+                if not count:
+                    break
+                removed += count
+                await asyncio.sleep(CLEAR_LOG_PAUSE)
+            if removed:
+                self._logger.info(f"Removed {removed} log records")
             await asyncio.sleep(timedelta(days=1).total_seconds())
 
 
@@ -165,6 +243,7 @@ async def _main():
 
     async with asyncio.TaskGroup() as group:
         scheduler = Scheduler(group)
+        listener = None
 
         while not shutdown.shutdown:
             try:
@@ -174,6 +253,13 @@ async def _main():
                 await asyncio.sleep(5)
                 continue
 
+            if listener is None:
+                # The address is a setting, listen once the database is up.
+                try:
+                    listener = await notifier.listen(scheduler.notify)
+                except (OSError, OperationalError) as e:
+                    print(e)
+
             try:
                 scheduler.connected()
             except OperationalError as e:
@@ -186,7 +272,10 @@ async def _main():
                     print(e)
                     await scheduler.disconnected()
                     break
-                await asyncio.sleep(1)
+                await scheduler.wait_for_changes(POLL_INTERVAL)
+
+        if listener is not None:
+            listener.close()
 
         try:
             await scheduler.shutdown()
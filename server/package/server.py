@@ -1,25 +1,28 @@
+from collections import namedtuple
 from . import db
 from .entity import Entity
 
 
+ServerRow = namedtuple(
+    'ServerRow', ['id', 'status', 'heartbeat', 'capacity', 'busy_slots'])
+
+
 class Server(Entity):
+    __slots__ = ()
+    _table = 'servers'
+    _Row = ServerRow
+
     def is_idle(self):
         return self._fetch('status') == 'IDLE'
 
     def is_busy(self):
         return self._fetch('status') == 'BUSY'
 
-    def is_offline(self):
-        with db.cursor() as cursor:
-            cursor.execute(
-                "SELECT asked_server.status='OFFLINE' OR"
-                "       TIMESTAMPDIFF(SECOND, asked_server.heartbeat, NOW()) >"
-                "       required_setting.value"
-                " FROM servers AS asked_server, settings AS required_setting"
-                " WHERE asked_server.id=%s AND"
-                "       required_setting.name='server_timeout'", (self.id()))
-            r = cursor.fetchone()
-            return bool(r[0]) if r is not None else False
+    def capacity(self):
+        return self._fetch('capacity')
+
+    def busy_slots(self):
+        return self._fetch('busy_slots')
 
     def set_idle(self):
         return self._update('status', 'IDLE')
@@ -30,6 +33,13 @@ class Server(Entity):
     def set_offline(self):
         return self._update('status', 'OFFLINE')
 
+    def set_occupancy(self, busy_slots):
+        with db.cursor() as cursor:
+            cursor.execute("UPDATE servers SET busy_slots=%s, status=%s"
+                           " WHERE id=%s",
+                           (busy_slots, 'BUSY' if busy_slots else 'IDLE',
+                            self.id()))
+
     def update_heartbeat(self):
         with db.cursor() as cursor:
             cursor.execute(
@@ -39,37 +49,33 @@ class Server(Entity):
     def _jsonify(row):
         keys = [
             "id",
-            "status"
+            "status",
+            "capacity",
+            "busy_slots"
         ]
         return dict(zip(keys, row))
 
     @staticmethod
-    def create(server_id):
+    def create(server_id, capacity=1):
         with db.cursor() as cursor:
             cursor.execute("REPLACE INTO servers"
-                           " (id, status, heartbeat)"
-                           " VALUES (%s, %s, NOW()) RETURNING id",
-                           (server_id, 'IDLE'))
+                           " (id, status, heartbeat, capacity, busy_slots)"
+                           " VALUES (%s, %s, NOW(), %s, 0) RETURNING id",
+                           (server_id, 'IDLE', capacity))
             return Server(*cursor.fetchone())
 
     @staticmethod
     def list(jsonify=False):
         if jsonify:
             with db.cursor() as cursor:
-                cursor.execute("SELECT id, status FROM projects ORDER BY id")
+                cursor.execute("SELECT id, status, capacity, busy_slots"
+                               " FROM servers ORDER BY id")
                 return [Server._jsonify(row) for row in cursor]
 
         with db.cursor() as cursor:
             cursor.execute("SELECT id FROM servers ORDER BY id DESC")
             return [Server(*row) for row in cursor]
 
-    def _fetch(self, field):
-        with db.cursor() as cursor:
-            cursor.execute(f"SELECT {field} FROM servers WHERE id=%s",
-                           (self.id()))
-            r = cursor.fetchone()
-            return r[0] if r is not None else None
-
     def _update(self, field, value):
         with db.cursor() as cursor:
             cursor.execute(f"UPDATE servers SET {field}=%s WHERE id=%s",
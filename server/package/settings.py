@@ -9,6 +9,20 @@ def storage_dir():
     return _fetch('storage_dir')
 
 
+def log_retention_days():
+    return int(_fetch('log_retention_days'))
+
+
+def git_jobs():
+    return int(_fetch('git_jobs'))
+
+
+def scheduler_address():
+    # "host:port"
+    host, _, port = _fetch('scheduler_address').rpartition(':')
+    return host, int(port)
+
+
 def _fetch(name):
     with db.cursor() as cursor:
         cursor.execute("SELECT value FROM settings WHERE name=%s", (name))
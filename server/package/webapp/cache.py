@@ -0,0 +1,48 @@
+from collections import OrderedDict
+import functools
+import threading
+
+from flask import Response, request, make_response
+from .. import queue_revision
+
+# Listings of requests and builds only change with the queue revision, which
+# is bumped on every change of requests and builds. Responses carry the
+# revision as ETag, clients get 304 while it did not change, and identical
+# queries are answered from memory.
+
+MAX_ENTRIES = 256
+
+_lock = threading.Lock()
+# request.full_path: (revision, body)
+_cache: OrderedDict[str, tuple[int, bytes]] = OrderedDict()
+
+
+def by_queue_revision(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        revision = queue_revision.current()
+        etag = f"queue-{revision}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            key = request.full_path
+            with _lock:
+                entry = _cache.get(key)
+                if entry is not None:
+                    _cache.move_to_end(key)
+            if entry is not None and entry[0] == revision:
+                response = Response(entry[1], mimetype="application/json")
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                with _lock:
+                    _cache[key] = (revision, response.get_data())
+                    _cache.move_to_end(key)
+                    while len(_cache) > MAX_ENTRIES:
+                        _cache.popitem(last=False)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
@@ -18,11 +18,16 @@ def _init_logger(level='WARNING'):
     return logger
 
 
+_CONNECT_ARGS = {
+    'host': '127.0.0.1', 'port': 3306,
+    'user': 'mysql', 'password': 'mysql',
+    'db': 'waffle_queue', 'autocommit': False,
+}
+
+
 def _create_pool():
     # _logger.setLevel('DEBUG')
-    return ConnectionPool(host='127.0.0.1', port=3306,
-                          user='mysql', password='mysql',
-                          db='waffle_queue', autocommit=False)
+    return ConnectionPool(**_CONNECT_ARGS)
 
 
 _logger = lazy_object_proxy.Proxy(_init_logger)
@@ -101,6 +106,11 @@ class ConnectionPool:
         _logger.debug(f"pool size: {len(self._pool)}")
 
 
+def create_connection():
+    """A connection outside of the pool for background threads"""
+    return Connection(**_CONNECT_ARGS)
+
+
 def connection():
     elapsed_time = 0
     delay = 0.1
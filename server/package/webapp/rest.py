@@ -1,19 +1,23 @@
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-import time
+import json
+import mimetypes
 from flask import Blueprint, Response, request, abort, send_file, stream_with_context
 import werkzeug.exceptions as ex
 from pymysql.err import OperationalError, IntegrityError
 import jwt
-from .. import settings
-from ..build import Build
-from ..request import Request
-from ..logger import Logger
-from . import db
+from .. import settings, notifier
+from ..build import Build, BUILD_FIELDS
+from ..request import Request, PRIORITY_MAX
+from ..logger import Logger, SEVERITIES
+from . import db, tail, cache
 
 bp = Blueprint("rest", __name__, url_prefix="/api/v1")
 
 JWT_SECRET = "IceCreamFruitWaffle"
+# A public download must start within the token lifetime. Range requests may
+# resume it for this much longer.
+JWT_RESUME_TIME = timedelta(days=1)
 
 
 def storage_dir():
@@ -39,7 +43,9 @@ def http_exception(exc):
 
 @bp.after_request
 def add_cache_controls(response):
-    response.cache_control.no_store = True
+    # Responses that can be revalidated (files with an ETag) set no-cache.
+    if not response.cache_control.no_cache:
+        response.cache_control.no_store = True
     return response
 
 
@@ -53,50 +59,67 @@ def db_commit(_exc):
 
 
 @bp.route('/requests', methods=['GET'])
+@cache.by_queue_revision
 def get_requests():
-    limit = request.args.get("limit", 25, type=int)
-    offset = request.args.get("offset", 0, type=int)
-    if limit < 1 or limit > 100 or offset < 0:
-        return abort(400)
-    return {
-        "count": Request.count(),
-        "limit": limit,
-        "offset": offset,
-        'content': Request.list(offset, limit, jsonify=True),
-    }
+    return _list_requests()
 
 
-@bp.route('/builds/<request_id>', methods=['GET'])
+@bp.route('/builds/<int:request_id>', methods=['GET'])
+@cache.by_queue_revision
 def get_builds(request_id):
     return {
         "request_id": request_id,
-        'content': Build.list(request_id, jsonify=True),
+        'content': Build.list_many([request_id])[request_id],
     }
 
 
+@bp.route('/queue', methods=['GET'])
+@cache.by_queue_revision
+def get_queue():
+    # A page of requests like /requests, each with its builds like
+    # /builds/<request_id>. fields selects the fields of the builds.
+    fields = request.args.get("fields", None, type=str)
+    if fields is not None:
+        fields = fields.split(",")
+        if not set(fields) <= set(BUILD_FIELDS):
+            return abort(400, "Unknown field")
+    response = _list_requests()
+    builds = Build.list_many([r["id"] for r in response["content"]], fields)
+    for r in response["content"]:
+        r["builds"] = builds[r["id"]]
+    return response
+
+
 @bp.route("/new_request", methods=["POST"])
 def new_request():
     project_name = request.form.get("project-name", "", type=str)
     request_type = request.form.get("request-type", "", type=str)
     source_branch = request.form.get("source-branch", "", type=str)
     target_branch = request.form.get("target-branch", "", type=str)
+    priority = request.form.get("priority", None, type=int)
     if any(i == "" for i in [project_name, source_branch]):
         return abort(400)
     if request_type != "Integration" and request_type != "Build":
         return abort(400)
     if request_type == "Integration" and target_branch == "":
         return abort(400, "Missing target branch name")
+    if priority is not None and not 0 <= priority <= PRIORITY_MAX:
+        return abort(400, "Invalid priority")
     try:
         Request.create(project_name, request_type == "Integration",
-                       source_branch, target_branch)
+                       source_branch, target_branch, priority)
     except IntegrityError:
         return abort(400, "Unknown project")
+    db.commit()
+    notifier.notify("request")
     return {}
 
 
 @bp.route("/abort/<request_id>", methods=["POST"])
 def abort_request(request_id):
     Request(request_id).set_aborted()
+    db.commit()
+    notifier.notify("request")
     return {}
 
 
@@ -104,13 +127,39 @@ def abort_request(request_id):
 def get_log():
     server_id = request.args.get("server_id", -1, type=int)
     severity = request.args.get("max_severity", "TRACE", type=str)
+    since_id = request.args.get("since_id", 0, type=int)
+    limit = request.args.get("limit", None, type=int)
+    try:
+        start = _local_time(request.args.get("from", None, type=str))
+        end = _local_time(request.args.get("to", None, type=str))
+    except ValueError:
+        return abort(400, "Invalid time")
     if server_id < 0:
         return abort(400, "Missing build id")
-    return {
-        'server_id': server_id,
-        'max_severity': severity,
-        'content': Logger.list(server_id, max_severity=severity)
-    }
+    if severity not in SEVERITIES:
+        return abort(400, "Unknown severity")
+    if since_id < 0 or (limit is not None and limit < 1):
+        return abort(400)
+
+    # The log can be large, it is streamed as it is read. last_id comes last,
+    # clients pass it as since_id to only get newer records next time.
+    @stream_with_context
+    def stream():
+        yield (f'{{"server_id": {server_id},'
+               f' "max_severity": {json.dumps(severity)},'
+               ' "content": "')
+        last_id = since_id
+        separator = ""
+        for row in Logger.list(server_id, max_severity=severity,
+                               since_id=since_id, start=start, end=end,
+                               limit=limit):
+            last_id = row[0]
+            line = f"{separator}{row[1]} {row[2]}\t{row[3]}"
+            yield json.dumps(line)[1:-1]
+            separator = "\n"
+        yield f'", "last_id": {last_id}}}'
+
+    return Response(stream(), mimetype="application/json")
 
 
 @bp.route("/result/<int:build_id>/<path:item>", methods=['GET'])
@@ -122,41 +171,16 @@ def get_result(build_id, item):
         return abort(404, "No such file or directory")
 
     if not build.is_building():
-        return send_file(path, mimetype="text/plain")
+        return _send_file(path)
 
-    @stream_with_context
-    def stream():
-        try:
-            with open(path, mode="r", encoding="utf-8") as f:
-                # Yield all but the last line in case it is incomplete
-                data = f.read()
-                end = data.rfind("\n")
-                if end > -1:
-                    yield data[:end]
-                    rest = data[end:]
-                else:
-                    rest = data
-
-                timeout = 0
-                while True:
-                    line = f.readline()
-                    if not line:
-                        db.commit()  # Needed for query to be up-to-date
-                        if not build.is_building():
-                            break
-                        time.sleep(1)
-                        timeout += 1
-                        if timeout > 30:
-                            yield "\n..."
-                            break
-                        continue
-                    timeout = 0
-                    yield rest + line
-                    rest = ""
-        except OSError as e:
-            yield str(e)
-
-    return Response(stream(), mimetype="text/plain")
+    # Streamed outside of the request context, the pooled connection is
+    # returned as soon as this returns.
+    start = 0
+    tail_size = request.args.get("tail", None, type=int)
+    if tail_size is not None and tail_size >= 0:
+        start = max(0, path.stat().st_size - tail_size)
+    return Response(tail.follow(build_id, path, start),
+                    mimetype=_mimetype(path))
 
 
 @bp.route("/public_url/<int:build_id>/<path:item>", methods=['GET'])
@@ -187,13 +211,16 @@ def get_public_url(build_id, item):
 
 @bp.route("/jwt/<path:token>", methods=['GET'])
 def public_download(token):
+    leeway = timedelta(seconds=2)
+    if "Range" in request.headers:
+        leeway += JWT_RESUME_TIME
     try:
         decoded = jwt.decode(
             token,
             JWT_SECRET,
             algorithms=["HS256"],
             options={"require": ["exp", "iat"]},
-            leeway=2.0,
+            leeway=leeway,
         )
         build = Build(decoded["build_id"])
         path = storage_dir() / str(decoded["build_id"]) / decoded["item"]
@@ -201,9 +228,65 @@ def public_download(token):
         if build.is_building() or not path.is_file():
             return abort(404, "No such file or directory")
 
-        return send_file(path)
+        return _send_file(path)
     except (
         jwt.exceptions.InvalidTokenError,
         TypeError,
     ):
         return abort(404)
+
+
+def _local_time(value):
+    # Logs are timestamped in naive local time. Times with an offset are
+    # converted to it.
+    if value is None:
+        return None
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone().replace(tzinfo=None)
+    return time
+
+
+def _mimetype(path):
+    mimetype, _ = mimetypes.guess_type(path.name)
+    if mimetype is None:
+        # build.log, or a build output without a known extension.
+        mimetype = ("text/plain" if path.suffix == ".log" else
+                    "application/octet-stream")
+    return mimetype
+
+
+def _send_file(path):
+    # Files of finished builds do not change. send_file answers conditional
+    # requests (ETag, Last-Modified) and Range requests so that downloads can
+    # be resumed. ?tail=N is a shortcut for the last N bytes, like a
+    # "Range: bytes=-N" header.
+    tail_size = request.args.get("tail", None, type=int)
+    if (tail_size or 0) > 0 and "Range" not in request.headers:
+        request.environ["HTTP_RANGE"] = f"bytes=-{tail_size}"
+    return send_file(path, mimetype=_mimetype(path), conditional=True,
+                     etag=True)
+
+
+def _list_requests():
+    limit = request.args.get("limit", 25, type=int)
+    offset = request.args.get("offset", 0, type=int)
+    before = request.args.get("before", None, type=int)
+    filters = {
+        "project": request.args.get("project", None, type=str),
+        "state": request.args.get("state", None, type=str),
+        "branch": request.args.get("branch", None, type=str),
+    }
+    if limit < 1 or limit > 100 or offset < 0:
+        return abort(400)
+    content = Request.list(offset, limit, jsonify=True, before=before,
+                           **filters)
+    return {
+        "count": Request.count(**filters),
+        "limit": limit,
+        "offset": offset,
+        "before": before,
+        # Pass as before to get the next page.
+        "next_before": content[-1]["id"] if content else None,
+        'content': content,
+    }
@@ -0,0 +1,149 @@
+import threading
+import time
+
+from pymysql.err import OperationalError, InterfaceError
+from . import db
+
+# Follows files of running builds for any number of viewers. A single thread
+# per process watches every followed build: it checks the file sizes and wakes
+# up the viewers of a file that grew, and checks the state of all followed
+# builds with one query. Viewers do not touch the database and do not hold a
+# pooled connection while they stream.
+
+# How often file sizes and build states are checked, in seconds.
+POLL_INTERVAL = 0.5
+STATE_INTERVAL = 2
+# Streams end after this many seconds without output.
+IDLE_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+
+class _Watch:
+    def __init__(self, path):
+        self.path = path
+        self.size = -1
+        self.building = True
+        self.viewers = 0
+        self.changed = threading.Condition(_lock)
+
+
+_lock = threading.Lock()
+# (build id, path): _Watch
+_watches: dict[tuple[int, object], _Watch] = {}
+_thread = None
+
+
+def follow(build_id, path, start=0):
+    # Yields the content of path from start, then what gets appended to it
+    # until the build ends.
+    key = (build_id, path)
+    watch = _acquire(key)
+    try:
+        with open(path, "rb") as f:
+            f.seek(start)
+            idle_since = time.monotonic()
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if data:
+                    idle_since = time.monotonic()
+                    yield data
+                    continue
+                idle = time.monotonic() - idle_since
+                if idle > IDLE_TIMEOUT:
+                    yield b"\n..."
+                    return
+                with _lock:
+                    building = watch.building
+                    # Only wait if the watcher did not see more data than
+                    # what was read, its wakeup may have come before.
+                    if building and f.tell() >= watch.size:
+                        watch.changed.wait(IDLE_TIMEOUT - idle)
+                if not building:
+                    # Read what was written before the build ended.
+                    while data := f.read(CHUNK_SIZE):
+                        yield data
+                    return
+    except OSError as e:
+        yield str(e).encode("utf-8")
+    finally:
+        _release(key)
+
+
+def _acquire(key):
+    global _thread  # pylint:disable = global-statement
+    with _lock:
+        watch = _watches.get(key)
+        if watch is None:
+            watch = _watches[key] = _Watch(key[1])
+        watch.viewers += 1
+        if _thread is None:
+            _thread = threading.Thread(target=_run, daemon=True)
+            _thread.start()
+        return watch
+
+
+def _release(key):
+    with _lock:
+        watch = _watches[key]
+        watch.viewers -= 1
+        if watch.viewers == 0:
+            del _watches[key]
+
+
+def _run():
+    global _thread  # pylint:disable = global-statement
+    conn = None
+    next_state_check = 0
+    try:
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with _lock:
+                if not _watches:
+                    _thread = None
+                    return
+                watches = dict(_watches)
+
+            for watch in watches.values():
+                try:
+                    size = watch.path.stat().st_size
+                except OSError:
+                    size = -1
+                with _lock:
+                    if size != watch.size:
+                        watch.size = size
+                        watch.changed.notify_all()
+
+            if time.monotonic() < next_state_check:
+                continue
+            next_state_check = time.monotonic() + STATE_INTERVAL
+            try:
+                if conn is None:
+                    conn = db.create_connection()
+                ended = _ended_builds(
+                    conn, list({build_id for build_id, _ in watches}))
+            except (OperationalError, InterfaceError) as e:
+                print(e)
+                continue
+            with _lock:
+                for (build_id, _), watch in watches.items():
+                    if build_id in ended:
+                        watch.building = False
+                        watch.changed.notify_all()
+    except BaseException:
+        with _lock:
+            _thread = None
+        raise
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _ended_builds(conn, build_ids):
+    placeholders = ", ".join(["%s"] * len(build_ids))
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id FROM builds"
+                       f" WHERE id IN ({placeholders})"
+                       " AND state<>'BUILDING'", build_ids)
+        ended = [row[0] for row in cursor]
+    conn.commit()  # Next query sees new changes
+    return ended
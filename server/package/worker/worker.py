@@ -1,9 +1,12 @@
 import asyncio
+import hashlib
+import json
+import os
+from collections import defaultdict
 from pathlib import Path
-from collections import deque
 from pymysql.err import OperationalError, InterfaceError
 from . import db
-from .. import runner, git, settings
+from .. import runner, git, settings, notifier, build_cache, artifacts
 from ..shutdown_handler import ShutdownHandler
 from ..task import Task
 from ..build import Build
@@ -11,13 +14,31 @@ from ..server import Server
 from ..logger import Logger
 
 
+class Slot:
+    def __init__(self, index, task):
+        self.index = index
+        self.task = task
+        self.build: Build = None
+        # (project, source_branch) of the last build in this slot
+        self.last_built = None
+        # Resolved commit by module work tree of the current build
+        self.commits = {}
+        self.cache_key = None
+
+
 class Worker:
-    def __init__(self, task_group, server_id):
+    def __init__(self, task_group, server_id, capacity=1):
         if server_id <= 0:
             raise TypeError("Server id cannot be zero or negative")
-        self._current_build: Build = None
-        self._current_build_task = Task(
-            task_group, self._start_build, self._on_build_finished)
+        if capacity <= 0:
+            raise TypeError("Capacity cannot be zero or negative")
+        self._slots = [
+            Slot(index, Task(task_group, self._start_build,
+                             self._on_build_finished))
+            for index in range(capacity)]
+        # Slots share the git directory of a project. Only one slot at a time
+        # can fetch and checkout from it.
+        self._git_locks = defaultdict(asyncio.Lock)
         self._server_id = server_id
         self._server: Server = None
         self._logger = Logger(server_id)
@@ -31,149 +52,296 @@ class Worker:
     def worker_dir(self):
         return self.waffle_root() / f"worker{str(self._server_id)}"
 
-    def project_dir(self):
-        return self.worker_dir() / self._current_build.project_name()
+    def git_cache_dir(self):
+        return self.waffle_root() / "git_cache"
+
+    def reference_dir(self, remote_url):
+        # Shared by all workers of the host, one per remote.
+        return self.git_cache_dir() / hashlib.sha1(
+            remote_url.encode("utf-8")).hexdigest()
+
+    def project_dir(self, slot):
+        return self.worker_dir() / slot.build.project_name()
 
-    def git_root(self):
-        return self.project_dir() / "git"
+    def git_root(self, slot):
+        return self.project_dir(slot) / "git"
 
-    def work_tree_root(self):
-        return self.project_dir() / "work_tree"
+    def work_tree_root(self, slot):
+        if slot.index == 0:
+            return self.project_dir(slot) / "work_tree"
+        return self.project_dir(slot) / f"work_tree{slot.index}"
 
     def connected(self):
-        self._server = Server.create(self._server_id)
+        self._server = Server.create(self._server_id, len(self._slots))
 
     async def disconnected(self):
-        if self._current_build is not None:
-            await self._current_build_task.cancel()
+        for slot in self._slots:
+            if slot.build is not None:
+                await slot.task.cancel()
 
     async def shutdown(self):
-        await self._current_build_task.cancel()
+        for slot in self._slots:
+            await slot.task.cancel()
         if self._server is not None:
             self._server.set_offline()
+        self._logger.close()
         db.commit()
 
     async def update(self):
         self._server.update_heartbeat()
         db.commit()
 
-        # Cancel task if the current build request was aborted.
-        if (self._current_build is not None and
-                self._current_build_task.running()):
-            if self._current_build.is_aborted():
-                await self._current_build_task.cancel()
-
-        # Check for new requests if this worker is idle.
-        if self._current_build is None:
-            build_request = Build.pop_next_build_request(self._server.id())
-            if build_request is not None:
-                self._current_build_task.start(build_request)
-
-    async def _start_build(self, build_request):
-        self._current_build = build_request
+        # Cancel tasks of aborted build requests.
+        busy_slots = [slot for slot in self._slots
+                      if slot.build is not None and slot.task.running()]
+        aborted = {build.id() for build in
+                   Build.load_many(slot.build.id() for slot in busy_slots)
+                   if build.is_aborted()}
+        for slot in busy_slots:
+            if slot.build.id() in aborted:
+                await slot.task.cancel()
+
+        # Check for new requests if this worker has free slots.
+        for slot in self._slots:
+            if slot.build is not None:
+                continue
+            build_request = Build.pop_next_build_request(
+                self._server.id(), self._affinity(slot))
+            if build_request is None:
+                break
+            slot.build = build_request
+            slot.task.start(slot)
+
+    def _affinity(self, slot):
+        # Prefer what this slot built last, then what the other slots built.
+        affinity = []
+        for s in [slot] + self._slots:
+            if s.last_built is not None and s.last_built not in affinity:
+                affinity.append(s.last_built)
+        return affinity
+
+    async def _start_build(self, slot):
+        build = slot.build
+        slot.last_built = (build.project(), build.source_branch())
+        slot.commits = {}
+        slot.cache_key = None
         print("Starting build: "
-              f"{self._current_build.id()}, "
-              f"{self._current_build.source_branch()}")
+              f"{build.id()}, "
+              f"{build.source_branch()}, slot: {slot.index}")
         self._logger.info("Starting build! id: "
-                          f"{self._current_build.id()}, "
-                          f"config: {self._current_build.build_config()}",
-                          commit=False)
+                          f"{build.id()}, "
+                          f"config: {build.build_config()}, "
+                          f"slot: {slot.index}")
 
         await asyncio.sleep(2)
 
         try:
-            self._server.set_busy()
+            self._update_occupancy()
             db.commit()
         except (OperationalError, InterfaceError):
             # Can happen when task gets canceled due to disconnection
             pass
 
-        modules = deque([[
+        root_module = [
             Path("."),  # git_dir
             Path("."),  # work_tree
-            self._current_build.remote_url(),  # remote url
-            "origin/" + self._current_build.source_branch()  # branch
-        ]])
+            build.remote_url(),  # remote url
+            "origin/" + build.source_branch()  # branch
+        ]
 
         try:
             # Fetch and checkout root module and all submodules.
-            while True:
-                try:
-                    module = modules.popleft()
-                except IndexError:
-                    break
-                print(module)
-                submodules = await self._prepare_module(*module)
-                for sm in submodules:
-                    modules.append(sm)
+            async with self._git_locks[build.project_name()]:
+                await self._prepare_module_tree(
+                    slot, asyncio.Semaphore(settings.git_jobs()), root_module)
 
-            # Run the build script.
-            storage_dir = self.storage_dir() / str(self._current_build.id())
+            storage_dir = self.storage_dir() / str(build.id())
             storage_dir.mkdir(parents=True, exist_ok=True)
+
+            # Reuse the result of an earlier build of the same sources.
+            cache_key = _cache_key(build, slot.commits)
+            cached_build_id = build_cache.lookup(
+                cache_key, build.output_file() or None)
+            if (cached_build_id is not None and
+                    self._link_result(cached_build_id, build)):
+                self._logger.info(f"Build {build.id()} reuses the result of"
+                                  f" build {cached_build_id}")
+                return 0
+            slot.cache_key = cache_key
+
+            # Run the build script.
             log_file = storage_dir / "build.log"
-            build_script = Path(self._current_build.build_script())
-            cwd = Path(self._current_build.work_dir())
+            build_script = Path(build.build_script())
+            cwd = Path(build.work_dir())
             with open(log_file, "wt", encoding="utf-8") as log_file_fd:
                 await runner.run(["python3",
-                                  str(self.work_tree_root() / build_script)],
-                                 cwd=self.work_tree_root() / cwd,
+                                  str(self.work_tree_root(slot) /
+                                      build_script)],
+                                 cwd=self.work_tree_root(slot) / cwd,
                                  output=log_file_fd,
                                  logger=self._logger)
 
-            # Copy output to storage
-            output_file = self._current_build.output_file()
+            # Store output by content so that identical outputs are stored
+            # once.
+            output_file = build.output_file()
             if output_file:
-                src = self.work_tree_root() / output_file
+                src = self.work_tree_root(slot) / output_file
                 dst = storage_dir / Path(output_file).name
-                await runner.run(["cp", str(src), str(dst)],
-                                 logger=self._logger)
+                try:
+                    await asyncio.to_thread(
+                        artifacts.store, self.storage_dir(), src, dst)
+                except OSError as e:
+                    self._logger.error(f"Cannot store output: {e}")
+                    return 1
         except runner.RunProcessError as e:
             return e.returncode
 
         return 0
 
-    def _on_build_finished(self, result, _):
-        print(f"Build finished: {self._current_build.id()}"
+    def _on_build_finished(self, result, slot):
+        build = slot.build
+        print(f"Build finished: {build.id()}"
               f" result: {str(result)}")
-        self._logger.info(f"Build finished: {self._current_build.id()}"
-                          f" result: {str(result)}", commit=False)
+        self._logger.info(f"Build finished: {build.id()}"
+                          f" result: {str(result)}")
         try:
             if result == 'CANCELED':
-                self._current_build.set_aborted()
+                build.set_aborted()
             elif result == 0:
-                self._current_build.set_succeeded()
+                build.set_succeeded()
+                if slot.cache_key is not None:
+                    build_cache.store(slot.cache_key, build.id(),
+                                      build.output_file() or None)
             else:
-                self._current_build.set_failed()
-            self._server.set_idle()
+                build.set_failed()
+            slot.build = None
+            self._update_occupancy()
             db.commit()
+            notifier.notify("build")
         except (OperationalError, InterfaceError):
             # Can happen when task gets canceled due to disconnection
             pass
         finally:
-            self._reset_current_build()
-
-    def _reset_current_build(self):
-        self._current_build = None
+            slot.build = None
+
+    def _link_result(self, cached_build_id, build):
+        # Hard link the log and output of the cached build into the storage of
+        # this build. Fails if the cached files were removed meanwhile. On
+        # failure the links made so far are removed, the build then writes its
+        # own files and must not write through a link into the cached build.
+        src_dir = self.storage_dir() / str(cached_build_id)
+        dst_dir = self.storage_dir() / str(build.id())
+        names = ["build.log"]
+        if build.output_file():
+            names.append(Path(build.output_file()).name)
+        linked = []
+        try:
+            for name in names:
+                (dst_dir / name).unlink(missing_ok=True)
+                os.link(src_dir / name, dst_dir / name)
+                linked.append(dst_dir / name)
+        except OSError:
+            for path in linked:
+                path.unlink(missing_ok=True)
+            return False
+        return True
+
+    def _update_occupancy(self):
+        self._server.set_occupancy(
+            sum(1 for slot in self._slots if slot.build is not None))
+
+    async def _prepare_module_tree(self, slot, semaphore, module):
+        # Submodules are prepared concurrently once their parent is ready.
+        # The semaphore limits the number of modules prepared at a time.
+        async with semaphore:
+            print(module)
+            submodules = await self._prepare_module(slot, *module)
 
-    async def _prepare_module(self, git_dir, work_tree, remote_url,
+        try:
+            async with asyncio.TaskGroup() as group:
+                for sm in submodules:
+                    group.create_task(
+                        self._prepare_module_tree(slot, semaphore, sm))
+        except ExceptionGroup as e:
+            # Siblings are canceled on the first failure. Report it as if the
+            # modules were prepared one by one.
+            raise e.exceptions[0] from None
+
+    # pylint:disable = too-many-arguments
+    async def _prepare_module(self, slot, git_dir, work_tree, remote_url,
                               commit_or_branch):
-        abs_work_tree = self.work_tree_root() / work_tree
+        abs_work_tree = self.work_tree_root(slot) / work_tree
         abs_work_tree.mkdir(parents=True, exist_ok=True)
-        abs_git_dir = self.git_root() / git_dir
+        abs_git_dir = self.git_root(slot) / git_dir
         abs_git_dir.mkdir(parents=True, exist_ok=True)
 
-        await git.init_or_update(abs_git_dir, "origin", remote_url,
-                                 logger=self._logger)
-        await git.fetch(abs_git_dir, "origin", commit_or_branch.split("/")[-1],
-                        logger=self._logger)
-        await git.checkout(abs_git_dir, abs_work_tree, commit_or_branch,
-                           logger=self._logger)
-        await git.clean(abs_git_dir, abs_work_tree, logger=self._logger)
-        output = await git.init_submodules(abs_git_dir, abs_work_tree,
-                                           logger=self._logger)
+        # Shallow and partial fetches bypass the shared reference, it would
+        # download everything they are meant to skip.
+        build = slot.build
+        depth = build.fetch_depth()
+        filter_spec = build.clone_filter()
+        reference = None
+        if depth is None and filter_spec is None:
+            reference = self.reference_dir(remote_url)
+        # Sparse checkout only applies to the root module.
+        sparse_patterns = []
+        if git_dir == Path("."):
+            sparse_patterns = build.sparse_checkout_patterns()
+
+        # Submodules are pinned to a commit, branches start with "origin/".
+        is_commit = not commit_or_branch.startswith("origin/")
+        last = _load_checkout(abs_git_dir)
+        same_tree = (last is not None and
+                     last["work_tree"] == str(abs_work_tree) and
+                     last["sparse_checkout"] == sparse_patterns)
+
+        if not (same_tree and is_commit and
+                last["commit"] == commit_or_branch):
+            await git.init_or_update(abs_git_dir, "origin", remote_url,
+                                     reference=reference, logger=self._logger)
+            await git.fetch(abs_git_dir, "origin",
+                            commit_or_branch.split("/")[-1],
+                            reference=reference, url=remote_url, depth=depth,
+                            filter_spec=filter_spec, logger=self._logger)
+        commit = commit_or_branch if is_commit else await git.rev_parse(
+            abs_git_dir, commit_or_branch, logger=self._logger)
+        slot.commits[str(work_tree)] = commit
+
+        if same_tree and last["commit"] == commit:
+            # The work tree is already at the commit. Only undo what the last
+            # build did unless the build is incremental.
+            if not build.incremental():
+                await git.checkout(abs_git_dir, abs_work_tree, commit,
+                                   logger=self._logger)
+                await git.clean(abs_git_dir, abs_work_tree,
+                                logger=self._logger)
+            output = last["submodules"]
+        else:
+            # Forget the last checkout in case this one gets interrupted.
+            _save_checkout(abs_git_dir, None)
+            await git.set_sparse_checkout(abs_git_dir, abs_work_tree,
+                                          sparse_patterns, logger=self._logger)
+            await git.checkout(abs_git_dir, abs_work_tree, commit,
+                               logger=self._logger)
+            if not build.incremental():
+                await git.clean(abs_git_dir, abs_work_tree,
+                                logger=self._logger)
+            output = await git.init_submodules(abs_git_dir, abs_work_tree,
+                                               logger=self._logger)
+            _save_checkout(abs_git_dir, {
+                "work_tree": str(abs_work_tree),
+                "commit": commit,
+                "sparse_checkout": sparse_patterns,
+                "submodules": output,
+            })
 
         submodules = []
         for submodule_dir, submodule_info in output.items():
+            # Submodules outside of the sparse checkout are not in the work
+            # tree and are skipped.
+            if sparse_patterns and not (
+                    abs_work_tree / submodule_dir).is_dir():
+                continue
             submodules.append([git_dir / "modules" / submodule_dir,
                                work_tree / submodule_dir,
                                submodule_info[0],
@@ -181,11 +349,46 @@ class Worker:
         return submodules
 
 
-async def _main(server_id):
+def _cache_key(build, commits):
+    key = {
+        "project": build.project_name(),
+        "build_config": build.build_config(),
+        "build_script": build.build_script(),
+        "work_dir": build.work_dir(),
+        "sparse_checkout": build.sparse_checkout_patterns(),
+        "commits": commits,
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# The last checkout done with a git directory. Lets the worker skip the git
+# steps that would not change anything.
+def _checkout_file(git_dir):
+    return git_dir / "waffle_checkout.json"
+
+
+def _load_checkout(git_dir):
+    try:
+        with open(_checkout_file(git_dir), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_checkout(git_dir, checkout):
+    if checkout is None:
+        _checkout_file(git_dir).unlink(missing_ok=True)
+        return
+    with open(_checkout_file(git_dir), "w", encoding="utf-8") as f:
+        json.dump(checkout, f)
+
+
+async def _main(server_id, capacity):
     shutdown = ShutdownHandler()
 
     async with asyncio.TaskGroup() as group:
-        worker = Worker(group, server_id)
+        worker = Worker(group, server_id, capacity)
 
         while not shutdown.shutdown:
             try:
@@ -215,5 +418,5 @@ async def _main(server_id):
             print(e)
 
 
-def run(server_id):
-    asyncio.run(_main(server_id))
+def run(server_id, capacity=1):
+    asyncio.run(_main(server_id, capacity))
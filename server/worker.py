@@ -8,5 +8,7 @@ if __name__ == "__main__":
         description="Worker daemon"
     )
     parser.add_argument("server_id", type=int, help="unique server id")
+    parser.add_argument("-c", "--capacity", type=int, default=1,
+                        help="number of builds to run concurrently")
     args = parser.parse_args()
-    worker.run(args.server_id)
+    worker.run(args.server_id, args.capacity)